@@ -0,0 +1,823 @@
+# ============================================================
+# 📏 Benchmark offline do ESTOQUE BOT
+# Reproduz mensagens pelo `responder` com Telegram, Gemini e Google Sheets falsos
+# (em processo, com latência configurável) e mede quanto custa cada mensagem.
+#
+# Uso:
+#   python bench.py --mensagens 500 --concorrencia 16 --produtos 2000
+#   python bench.py --latencia-llm 0.8 --latencia-sheets 0.3 --backend sqlite
+#   python bench.py --taxa-429 0.2 --ttl-cache 1   (Sheets devolvendo 429: backoff e cotas)
+#   python bench.py --estresse 32 --operacoes 50   (vendedores concorrentes; confere o saldo final)
+#   python bench.py --partida 5   (tempo de partida a frio até o ponto do primeiro poll)
+#   python bench.py --busca   (compras de nomes parecidos não caem em outro produto)
+#   python bench.py --webhook http://127.0.0.1:10000/telegram --updates updates.jsonl
+#     (carga HTTP num bot rodando com MODO_EXECUCAO=webhook; sem --updates gera o corpus)
+# ============================================================
+
+import os
+import re
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import io
+import subprocess
+import statistics
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+# =========================
+# 🔢 Contagem de chamadas externas
+# =========================
+class Contador:
+    """Contador thread-safe de chamadas externas por tipo (llm, sheets_leitura, ...)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.valores = Counter()
+
+    def somar(self, tipo: str, n: int = 1):
+        with self._lock:
+            self.valores[tipo] += n
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.valores.values())
+
+def dormir(latencia: float):
+    """Simula a latência de rede com ±20% de variação."""
+    if latencia > 0:
+        time.sleep(latencia * random.uniform(0.8, 1.2))
+
+# =========================
+# 📄 Google Sheets falso (gspread)
+# =========================
+class RespostaErroFake:
+    """Resposta HTTP mínima para montar um gspread.exceptions.APIError."""
+
+    def __init__(self, codigo: int, mensagem: str):
+        self.status_code = codigo
+        self.text = mensagem
+        self._corpo = {"error": {"code": codigo, "message": mensagem, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self) -> Dict[str, Any]:
+        return self._corpo
+
+class AbaFake:
+    """Imita o subconjunto de gspread.Worksheet usado pelo bot."""
+
+    def __init__(self, titulo: str, cabecalho: List[str], linhas: List[List[Any]], contador: Contador, latencia: float):
+        self.title = titulo
+        self.cabecalho = cabecalho
+        self.linhas = [list(l) for l in linhas]
+        self.contador = contador
+        self.latencia = latencia
+        self.taxa_429 = 0.0
+        self._lock = threading.Lock()
+
+    def _talvez_limitar(self):
+        """Responde 429 (cota excedida) numa fração das chamadas, como o Sheets sob carga."""
+        if self.taxa_429 and random.random() < self.taxa_429:
+            import gspread
+            self.contador.somar("sheets_429")
+            raise gspread.exceptions.APIError(RespostaErroFake(429, "Quota exceeded for quota metric 'Read requests'"))
+
+    def _celula(self, linha: int, coluna: int, valor: Any):
+        row = self.linhas[linha - 2]
+        while len(row) < coluna:
+            row.append("")
+        row[coluna - 1] = valor
+
+    def get_all_records(self, **kwargs) -> List[Dict[str, Any]]:
+        self.contador.somar("sheets_leitura")
+        dormir(self.latencia)
+        self._talvez_limitar()
+        with self._lock:
+            return [dict(zip(self.cabecalho, l)) for l in self.linhas]
+
+    def col_values(self, coluna: int, **kwargs) -> List[Any]:
+        self.contador.somar("sheets_leitura")
+        dormir(self.latencia)
+        self._talvez_limitar()
+        with self._lock:
+            return [self.cabecalho[coluna - 1]] + [l[coluna - 1] if len(l) >= coluna else "" for l in self.linhas]
+
+    def update_cell(self, linha: int, coluna: int, valor: Any):
+        self.contador.somar("sheets_escrita")
+        dormir(self.latencia)
+        self._talvez_limitar()
+        with self._lock:
+            self._celula(linha, coluna, valor)
+
+    def batch_update(self, dados, **kwargs):
+        self.contador.somar("sheets_escrita")
+        dormir(self.latencia)
+        self._talvez_limitar()
+        with self._lock:
+            for d in dados:
+                m = re.match(r"([A-Z]+)(\d+)", d["range"])
+                coluna = ord(m.group(1)[0]) - ord("A") + 1
+                linha = int(m.group(2))
+                for j, valor in enumerate(d["values"][0]):
+                    self._celula(linha, coluna + j, valor)
+        return {}
+
+    def append_row(self, valores, **kwargs):
+        return self.append_rows([valores], **kwargs)
+
+    def append_rows(self, linhas, **kwargs):
+        self.contador.somar("sheets_escrita")
+        dormir(self.latencia)
+        self._talvez_limitar()
+        with self._lock:
+            inicio = len(self.linhas) + 2
+            self.linhas.extend(list(l) for l in linhas)
+            fim = len(self.linhas) + 1
+        return {"updates": {"updatedRange": f"{self.title}!A{inicio}:F{fim}"}}
+
+class PlanilhaFake:
+    def __init__(self, abas: Dict[str, AbaFake], contador: Contador, latencia: float):
+        self.abas = abas
+        self.contador = contador
+        self.latencia = latencia
+
+    def worksheet(self, nome: str) -> AbaFake:
+        self.contador.somar("sheets_metadados")
+        dormir(self.latencia)
+        return self.abas[nome]
+
+class ClienteSheetsFake:
+    """Substitui o cliente gspread (main.gc)."""
+
+    def __init__(self, planilha: PlanilhaFake, contador: Contador, latencia: float):
+        self.planilha = planilha
+        self.contador = contador
+        self.latencia = latencia
+
+    def open(self, nome: str) -> PlanilhaFake:
+        self.contador.somar("sheets_metadados")
+        dormir(self.latencia)
+        return self.planilha
+
+    def open_by_key(self, chave: str) -> PlanilhaFake:
+        return self.open(chave)
+
+# =========================
+# 📅 Google Calendar falso
+# =========================
+class CalendarFake:
+    def __init__(self, contador: Contador, latencia: float):
+        self.contador = contador
+        self.latencia = latencia
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId: str, body: Dict[str, Any]):
+        calendario = self
+
+        class _Requisicao:
+            def execute(self):
+                calendario.contador.somar("calendar")
+                dormir(calendario.latencia)
+                return {"summary": body.get("summary"), "htmlLink": "https://calendar.example/evento"}
+
+        return _Requisicao()
+
+# =========================
+# 🤖 Gemini falso (respostas roteirizadas)
+# =========================
+def _resposta(partes: List[SimpleNamespace]) -> SimpleNamespace:
+    texto = next((p.text for p in partes if p.text), None)
+    conteudo = SimpleNamespace(parts=partes)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=conteudo)], text=texto)
+
+def _funcao(nome: str, **args) -> SimpleNamespace:
+    return SimpleNamespace(text=None, function_call=SimpleNamespace(name=nome, args=args))
+
+def _texto(texto: str) -> SimpleNamespace:
+    return SimpleNamespace(text=texto, function_call=None)
+
+# Tamanho estimado (tokens ~ caracteres / 4) de cada prompt enviado ao Gemini falso: histórico + mensagem
+TOKENS_PROMPT: List[int] = []
+
+class ChatFake:
+    """
+    Imita ChatSession.send_message: reconhece o corpus do benchmark e devolve
+    function_calls como o Gemini faria; resultados de função viram texto.
+    """
+
+    def __init__(self, contador: Contador, latencia: float, history=None):
+        self.contador = contador
+        self.latencia = latencia
+        self.history = list(history or [])
+
+    def send_message(self, mensagem: str):
+        self.contador.somar("llm")
+        dormir(self.latencia)
+        self.history.append({"role": "user", "parts": [mensagem]})
+        TOKENS_PROMPT.append(sum(len(str(p)) for c in self.history for p in c["parts"]) // 4)
+        resposta = self._roteiro(mensagem)
+        self.history.append({"role": "model", "parts": [p.text or p.function_call.name for p in resposta.candidates[0].content.parts]})
+        return resposta
+
+    def _roteiro(self, msg: str):
+        if msg.startswith("Resultado"):
+            return _resposta([_texto("Pronto! " + msg[:120])])
+        m = re.match(r"vendi (\d+) (.+) e (\d+) (.+)$", msg)
+        if m:
+            return _resposta([
+                _funcao("atualizar_saldo", produto=m.group(2), quantidade=float(m.group(1)), acao="VENDA"),
+                _funcao("atualizar_saldo", produto=m.group(4), quantidade=float(m.group(3)), acao="VENDA"),
+            ])
+        m = re.match(r"comprei (\d+) caixas de (.+)$", msg)
+        if m:
+            return _resposta([_funcao("atualizar_saldo", produto=m.group(2), quantidade=float(m.group(1)) * 12, acao="COMPRA")])
+        m = re.match(r"me diz quanto sobrou de (.+?)\??$", msg)
+        if m:
+            return _resposta([_funcao("obter_saldo", produto=m.group(1))])
+        m = re.match(r"agenda (.+) dia (\S+) às (\S+)$", msg)
+        if m:
+            return _resposta([_funcao("registrar_evento", titulo=m.group(1), descricao="", data=m.group(2), hora=m.group(3))])
+        return _resposta([_texto("Certo! Como posso ajudar com o estoque?")])
+
+class ModeloFake:
+    """Substitui o GenerativeModel compartilhado (main._modelo)."""
+
+    def __init__(self, contador: Contador, latencia: float):
+        self.contador = contador
+        self.latencia = latencia
+
+    def start_chat(self, history=None):
+        return ChatFake(self.contador, self.latencia, history)
+
+# =========================
+# 💬 Telegram falso
+# =========================
+class MensagemFake:
+    def __init__(self, texto: str, contador: Contador, latencia: float):
+        self.text = texto
+        self.contador = contador
+        self.latencia = latencia
+        self.respostas: List[str] = []
+
+    async def reply_text(self, texto: str, **kwargs):
+        self.contador.somar("telegram")
+        if self.latencia > 0:
+            await asyncio.sleep(self.latencia)
+        self.respostas.append(texto)
+
+def update_fake(user_id: int, texto: str, contador: Contador, latencia: float) -> SimpleNamespace:
+    """Objeto com os atributos de telegram.Update que o responder usa."""
+    return SimpleNamespace(
+        message=MensagemFake(texto, contador, latencia),
+        effective_user=SimpleNamespace(id=user_id, first_name=f"Operador{user_id}"),
+    )
+
+# =========================
+# 🧪 Catálogo e corpus
+# =========================
+MARCAS = [
+    "Skol", "Brahma", "Heineken", "Antarctica", "Budweiser", "Stella Artois", "Corona", "Original",
+    "Vodka Smirnoff", "Vodka Absolut", "Whisky Red Label", "Gin Tanqueray", "Coca-Cola",
+    "Guaraná Antarctica", "Água Mineral", "Energético Red Bull",
+]
+EMBALAGENS = ["Lata 350ml", "Long Neck 330ml", "Garrafa 600ml", "Litrão 1L", "Pack 12un"]
+
+def gerar_catalogo(n: int) -> List[str]:
+    nomes = []
+    lote = 0
+    while len(nomes) < n:
+        for marca in MARCAS:
+            for emb in EMBALAGENS:
+                nomes.append(f"{marca} {emb}" + (f" Lote {lote}" if lote else ""))
+        lote += 1
+    return nomes[:n]
+
+def gerar_corpus(catalogo: List[str], n: int, semente: int) -> List[str]:
+    """Mistura de tráfego real: maioria de consultas e vendas curtas, o resto precisa do Gemini."""
+    rnd = random.Random(semente)
+    tipos = [
+        ("saldo", 30), ("venda", 30), ("saldo_livre", 15), ("caixas", 10), ("multi", 10), ("evento", 5),
+    ]
+    populacao = [t for t, peso in tipos for _ in range(peso)]
+    corpus = []
+    for _ in range(n):
+        tipo = rnd.choice(populacao)
+        p1, p2 = rnd.sample(catalogo, 2)
+        if tipo == "saldo":
+            corpus.append(f"qual o saldo de {p1}?")
+        elif tipo == "venda":
+            corpus.append(f"vendi {rnd.randint(1, 6)} {p1}")
+        elif tipo == "saldo_livre":
+            corpus.append(f"me diz quanto sobrou de {p1}?")
+        elif tipo == "caixas":
+            corpus.append(f"comprei {rnd.randint(1, 5)} caixas de {p1}")
+        elif tipo == "multi":
+            corpus.append(f"vendi {rnd.randint(1, 4)} {p1} e {rnd.randint(1, 4)} {p2}")
+        else:
+            corpus.append(f"agenda entrega de {p1} dia 2026-12-{rnd.randint(10, 28)} às 10:00")
+    return corpus
+
+# =========================
+# 🚀 Execução
+# =========================
+def preparar_ambiente(args) -> str:
+    """Configura variáveis de ambiente antes de importar o main (a config é lida na importação)."""
+    pasta = tempfile.mkdtemp(prefix="estoque-bench-")
+    os.environ.setdefault("MEMORY_FOLDER", os.path.join(pasta, "memory_users"))
+    os.environ.setdefault("ESCRITA_JOURNAL", os.path.join(pasta, "fila_escrita.jsonl"))
+    os.environ.setdefault("ESTOQUE_DB", os.path.join(pasta, "estoque.db"))
+    os.environ["ESTOQUE_BACKEND"] = args.backend
+    os.environ["CACHE_ESTOQUE_TTL"] = str(args.ttl_cache)
+    if args.sem_atalho:
+        os.environ["ATALHO_ATIVO"] = "0"
+    return pasta
+
+def instalar_fakes(main, args, catalogo: List[str], contador: Contador):
+    estoque = AbaFake(
+        main.ABA_ESTOQUE, ["Produto", "Quantidade", "Atualizado em"],
+        [[nome, 1000, ""] for nome in catalogo], contador, args.latencia_sheets,
+    )
+    movs = AbaFake(
+        main.ABA_MOV, ["Data", "Produto", "Quantidade", "Tipo", "Responsável", "Observação"],
+        [], contador, args.latencia_sheets,
+    )
+    estoque.taxa_429 = movs.taxa_429 = args.taxa_429
+    planilha = PlanilhaFake({main.ABA_ESTOQUE: estoque, main.ABA_MOV: movs}, contador, args.latencia_sheets)
+    main.gc = ClienteSheetsFake(planilha, contador, args.latencia_sheets)
+    main.calendar_service = CalendarFake(contador, args.latencia_calendar)
+    main._modelo = ModeloFake(contador, args.latencia_llm)
+    return planilha
+
+def percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = min(len(ordenados) - 1, max(0, int(round(p / 100.0 * (len(ordenados) - 1)))))
+    return ordenados[k]
+
+async def reproduzir(main, corpus: List[str], args, contador: Contador) -> Dict[str, Any]:
+    semaforo = asyncio.Semaphore(args.concorrencia)
+    latencias: List[float] = []
+    sem_resposta = 0
+
+    async def enviar(i: int, texto: str):
+        nonlocal sem_resposta
+        update = update_fake(1000 + i % args.usuarios, texto, contador, args.latencia_telegram)
+        async with semaforo:
+            inicio = time.perf_counter()
+            await main.responder(update, None)
+            latencias.append(time.perf_counter() - inicio)
+        if not update.message.respostas:
+            sem_resposta += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(enviar(i, texto) for i, texto in enumerate(corpus)))
+    duracao = time.perf_counter() - inicio
+    return {"latencias": latencias, "duracao": duracao, "sem_resposta": sem_resposta}
+
+def executar(args) -> Dict[str, Any]:
+    random.seed(args.semente)
+    preparar_ambiente(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    contador = Contador()
+    catalogo = gerar_catalogo(args.produtos)
+    instalar_fakes(main, args, catalogo, contador)
+    corpus = gerar_corpus(catalogo, args.mensagens, args.semente)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    else:
+        logging.getLogger("estoque_bot").setLevel(logging.WARNING)
+    saida = io.StringIO()
+    redirecionar = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(saida)
+    with redirecionar:
+        # Em produção o aquecimento depois do primeiro poll já importou o gspread (classes de erro)
+        import gspread  # noqa: F401
+        main.backend_estoque.iniciar()
+        chamadas_iniciais = Counter(contador.valores)
+        resultado = asyncio.run(reproduzir(main, corpus, args, contador))
+        # Grava o que ficou na fila para contar também as escritas em lote
+        main.backend_estoque.encerrar()
+        main.memoria_usuarios.encerrar()
+
+    chamadas = Counter(contador.valores)
+    chamadas.subtract(chamadas_iniciais)
+    n = max(len(corpus), 1)
+    latencias = resultado["latencias"]
+    return {
+        "mensagens": len(corpus),
+        "concorrencia": args.concorrencia,
+        "usuarios": args.usuarios,
+        "produtos": args.produtos,
+        "backend": args.backend,
+        "atalho": not args.sem_atalho,
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+        "max_ms": max(latencias) * 1000 if latencias else 0.0,
+        "msg_por_s": len(corpus) / resultado["duracao"] if resultado["duracao"] else 0.0,
+        "chamadas_por_msg": sum(chamadas.values()) / n,
+        "chamadas_por_tipo": {k: v / n for k, v in sorted(chamadas.items()) if v},
+        "sem_resposta": resultado["sem_resposta"],
+        "etapas_ms": {
+            serie: soma * 1000 / total
+            for serie, (total, soma) in sorted(main.metricas.resumo("estoque_etapa_segundos").items()) if total
+        },
+        "carga_inicial": dict(chamadas_iniciais),
+        "tokens_prompt_media": statistics.mean(TOKENS_PROMPT) if TOKENS_PROMPT else 0.0,
+        "tokens_prompt_max": max(TOKENS_PROMPT, default=0),
+        "cotas": {nome: cota.estatisticas() for nome, cota in main.COTAS.items()},
+        "leituras_unidas": main.leituras_em_voo.unidas,
+    }
+
+def imprimir_relatorio(r: Dict[str, Any]):
+    print("📏 Benchmark ESTOQUE BOT")
+    print(f"   mensagens: {r['mensagens']} | concorrência: {r['concorrencia']} | usuários: {r['usuarios']} | "
+          f"produtos: {r['produtos']} | backend: {r['backend']} | atalho: {'sim' if r['atalho'] else 'não'}")
+    print(f"   latência p50: {r['p50_ms']:.1f} ms | p99: {r['p99_ms']:.1f} ms | máx: {r['max_ms']:.1f} ms")
+    print(f"   vazão: {r['msg_por_s']:.1f} msg/s")
+    detalhe = ", ".join(f"{k}: {v:.2f}" for k, v in r["chamadas_por_tipo"].items())
+    print(f"   chamadas externas por mensagem: {r['chamadas_por_msg']:.2f} ({detalhe})")
+    print(f"   prompt do Gemini (histórico + mensagem): média {r['tokens_prompt_media']:.0f} tokens | máx: {r['tokens_prompt_max']} tokens")
+    if r["etapas_ms"]:
+        print("   tempo médio por etapa:")
+        for serie, ms in r["etapas_ms"].items():
+            print(f"     {serie:<40} {ms:8.2f} ms")
+    print("   cotas Google: " + " | ".join(
+        f"{nome}: {c['limitadas']}/{c['chamadas']} limitadas, espera {c['espera_s']}s, retentativas {c['retentativas']}"
+        for nome, c in r["cotas"].items() if c["chamadas"]
+    ) + f" | leituras unidas: {r['leituras_unidas']}")
+    if r["sem_resposta"]:
+        print(f"   ⚠️ mensagens sem resposta: {r['sem_resposta']}")
+
+# =========================
+# 🔥 Estresse: vendedores concorrentes nos mesmos produtos
+# =========================
+PRODUTO_NOVO_ESTRESSE = "Produto Estresse Novo"
+SALDO_INICIAL = 1000
+
+def planejar_vendedor(rnd: random.Random, catalogo: List[str], operacoes: int) -> List[tuple]:
+    """
+    Vendas e compras de 1 a 3 unidades; 1 em cada 10 vira um /lote de 3 linhas. Antes de tudo,
+    o produto novo é comprado uma vez avulso e uma vez dentro de um /lote (em ordem sorteada).
+    """
+    ops: List[tuple] = []
+    for _ in range(operacoes):
+        if rnd.random() < 0.1:
+            ops.append(("lote", [(rnd.choice(catalogo), rnd.randint(1, 3), rnd.choice(["VENDA", "COMPRA"])) for _ in range(3)]))
+        else:
+            ops.append(("unica", [(rnd.choice(catalogo), rnd.randint(1, 3), rnd.choice(["VENDA", "VENDA", "COMPRA"]))]))
+    # Logo no começo: todos os vendedores disputam o cadastro do mesmo produto novo
+    novos = [("unica", [(PRODUTO_NOVO_ESTRESSE, 1, "COMPRA")]), ("lote", [(rnd.choice(catalogo), 1, "VENDA"), (PRODUTO_NOVO_ESTRESSE, 2, "COMPRA")])]
+    rnd.shuffle(novos)
+    ops[:0] = novos
+    return ops
+
+def estresse(args) -> Dict[str, Any]:
+    random.seed(args.semente)
+    # A cota não é o que está em teste aqui: sem ela os vendedores se atropelam de verdade
+    for var in ("COTA_SHEETS_LEITURA_MIN", "COTA_SHEETS_ESCRITA_MIN"):
+        os.environ.setdefault(var, "1000000")
+    preparar_ambiente(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    if not args.verbose:
+        logging.getLogger("estoque_bot").setLevel(logging.WARNING)
+    contador = Contador()
+    catalogo = gerar_catalogo(args.produtos_estresse)
+    planilha = instalar_fakes(main, args, catalogo, contador)
+    main.backend_estoque.iniciar()
+    # Estoque já carregado, como no bot em produção: os vendedores disputam só as escritas
+    main.backend_estoque.buscar(catalogo[0])
+
+    rnd = random.Random(args.semente)
+    planos = [planejar_vendedor(rnd, catalogo, args.operacoes) for _ in range(args.estresse)]
+    esperado = Counter()
+    for ops in planos:
+        for _, linhas in ops:
+            for produto, qtd, acao in linhas:
+                esperado[produto] += -qtd if acao == "VENDA" else qtd
+
+    def vendedor(v: int) -> int:
+        falhas = 0
+        for tipo, linhas in planos[v]:
+            if tipo == "lote":
+                r = main.registrar_lote("\n".join(f"{p};{q};{a}" for p, q, a in linhas), f"Vendedor{v}")
+                falhas += r.get("status") != "sucesso" or any(l["status"] != "sucesso" for l in r["linhas"])
+            else:
+                produto, qtd, acao = linhas[0]
+                falhas += main.atualizar_saldo(produto, qtd, acao, responsavel=f"Vendedor{v}").get("status") != "sucesso"
+        return falhas
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.estresse) as pool:
+        falhas = sum(pool.map(vendedor, range(args.estresse)))
+    duracao = time.perf_counter() - inicio
+    main.backend_estoque.encerrar()
+    main.memoria_usuarios.encerrar()
+
+    # Confere a aba Estoque falsa depois do último flush/sincronização
+    linhas_estoque: Dict[str, List[int]] = {}
+    for linha in planilha.abas[main.ABA_ESTOQUE].linhas:
+        linhas_estoque.setdefault(linha[0], []).append(int(linha[1]))
+    divergencias = []
+    for produto in catalogo:
+        final, correto = linhas_estoque.get(produto, [None])[0], SALDO_INICIAL + esperado[produto]
+        if final != correto:
+            divergencias.append({"produto": produto, "planilha": final, "esperado": correto})
+    novo = linhas_estoque.get(PRODUTO_NOVO_ESTRESSE, [])
+    # Uma única linha na planilha, com todas as compras somadas
+    if novo != [esperado[PRODUTO_NOVO_ESTRESSE]]:
+        divergencias.append({"produto": PRODUTO_NOVO_ESTRESSE, "planilha": novo, "esperado": [esperado[PRODUTO_NOVO_ESTRESSE]]})
+    total_movs = sum(len(linhas) for ops in planos for _, linhas in ops)
+    movs_gravadas = len(planilha.abas[main.ABA_MOV].linhas)
+    if movs_gravadas != total_movs:
+        divergencias.append({"produto": "(movimentações)", "planilha": movs_gravadas, "esperado": total_movs})
+    return {
+        "vendedores": args.estresse,
+        "operacoes": sum(len(ops) for ops in planos),
+        "movimentacoes": total_movs,
+        "produtos": len(catalogo),
+        "backend": args.backend,
+        "duracao_s": duracao,
+        "ops_por_s": sum(len(ops) for ops in planos) / duracao if duracao else 0.0,
+        "falhas": falhas,
+        "esperas_lock": main.locks_produto.esperas,
+        "divergencias": divergencias,
+    }
+
+def imprimir_relatorio_estresse(r: Dict[str, Any]):
+    print("🔥 Estresse de vendedores concorrentes")
+    print(f"   vendedores: {r['vendedores']} | operações: {r['operacoes']} ({r['movimentacoes']} movimentações) | "
+          f"produtos: {r['produtos']} | backend: {r['backend']}")
+    print(f"   duração: {r['duracao_s']:.2f} s | {r['ops_por_s']:.1f} op/s | esperas no lock por produto: {r['esperas_lock']}")
+    if r["falhas"]:
+        print(f"   ⚠️ operações com erro: {r['falhas']}")
+    if r["divergencias"]:
+        print(f"   ❌ {len(r['divergencias'])} saldos divergentes:")
+        for d in r["divergencias"][:10]:
+            print(f"     {d['produto']}: planilha {d['planilha']} | esperado {d['esperado']}")
+    else:
+        print("   ✅ saldos finais e movimentações conferem com a soma das operações")
+
+# =========================
+# 🔎 Resolução de nomes (escrita exige nome exato ou termos cobertos)
+# =========================
+CATALOGO_BUSCA = ["Skol Lata 350ml", "Coca-Cola 2L", "Heineken Long Neck", "Vodka Smirnoff", "Guaraná Antarctica 2L"]
+# (texto da compra, produto que deve receber a entrada; None = não pode cair num produto existente)
+CASOS_ESCRITA = [
+    ("Skol Lata 600ml", None), ("Coca-Cola Zero 2L", None), ("Heineken Lata", None), ("Vodka Smirnoff Ice", None),
+    ("skol lata 350ml", "Skol Lata 350ml"), ("Skol Lata", "Skol Lata 350ml"), ("heineken long", "Heineken Long Neck"),
+    ("guarana antarctica 2l", "Guaraná Antarctica 2L"),
+]
+# Consultas de saldo continuam tolerantes
+CASOS_LEITURA = [("Heineken Lata", "Heineken Long Neck"), ("vodka smirnof", "Vodka Smirnoff")]
+
+def conferir_busca(args) -> Dict[str, Any]:
+    preparar_ambiente(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    if not args.verbose:
+        logging.getLogger("estoque_bot").setLevel(logging.WARNING)
+    args.latencia_sheets = args.latencia_calendar = args.latencia_llm = 0
+    planilha = instalar_fakes(main, args, CATALOGO_BUSCA, Contador())
+    main.backend_estoque.iniciar()
+    divergencias = []
+    esperado = Counter({nome: 1000 for nome in CATALOGO_BUSCA})
+    for consulta, alvo in CASOS_ESCRITA:
+        r = main.atualizar_saldo(consulta, 5, "COMPRA", responsavel="Bench")
+        obtido = r.get("produto") if r.get("status") == "sucesso" else r.get("status")
+        if alvo is None and r.get("status") != "ambiguo":
+            divergencias.append({"caso": f"compra '{consulta}'", "obtido": obtido, "esperado": "ambiguo"})
+        elif alvo is not None and obtido != alvo:
+            divergencias.append({"caso": f"compra '{consulta}'", "obtido": obtido, "esperado": alvo})
+        if alvo is not None:
+            esperado[alvo] += 5
+    # Depois de o usuário confirmar, o produto novo ganha a própria linha
+    r = main.atualizar_saldo("Skol Lata 600ml", 5, "COMPRA", responsavel="Bench", produto_novo=True)
+    if r.get("produto") != "Skol Lata 600ml":
+        divergencias.append({"caso": "compra 'Skol Lata 600ml' (produto_novo)", "obtido": r.get("produto") or r.get("status"), "esperado": "Skol Lata 600ml"})
+    esperado["Skol Lata 600ml"] = 5
+    for consulta, alvo in CASOS_LEITURA:
+        obtido = main.obter_saldo(consulta).get("produto")
+        if obtido != alvo:
+            divergencias.append({"caso": f"saldo '{consulta}'", "obtido": obtido, "esperado": alvo})
+    main.backend_estoque.encerrar()
+    main.memoria_usuarios.encerrar()
+
+    saldos = {linha[0]: int(linha[1]) for linha in planilha.abas[main.ABA_ESTOQUE].linhas}
+    if saldos != dict(esperado):
+        divergencias.append({"caso": "aba Estoque", "obtido": saldos, "esperado": dict(esperado)})
+    return {"casos": len(CASOS_ESCRITA) + len(CASOS_LEITURA) + 1, "backend": args.backend, "divergencias": divergencias}
+
+def imprimir_relatorio_busca(r: Dict[str, Any]):
+    print(f"🔎 Resolução de nomes: {r['casos']} casos | backend: {r['backend']}")
+    for d in r["divergencias"]:
+        print(f"   ❌ {d['caso']}: obtido {d['obtido']} | esperado {d['esperado']}")
+    if not r["divergencias"]:
+        print("   ✅ escritas só em produto exato ou coberto; parecido volta ambíguo")
+
+# =========================
+# ⏱️ Partida a frio (processo novo a cada rodada)
+# =========================
+# google-auth fica de fora: é leve e o connect_to_google monta as credenciais na partida
+MODULOS_PESADOS = ["gspread", "googleapiclient.discovery", "google.generativeai"]
+
+# Roda num processo novo: importa o main e faz a mesma sequência do main() até o primeiro
+# poll (config, credenciais, backend), sem a parte de rede do Telegram. Só o Sheets é falso
+# (o backend sqlite lê a planilha na primeira partida); Gemini e Calendar ficam reais
+SCRIPT_PARTIDA = r"""
+import json, sys, time
+from types import SimpleNamespace
+inicio = time.perf_counter()
+import main
+importado = time.perf_counter()
+import bench
+main.verificar_configuracao()
+main.registrar_gauges()
+main.connect_to_google()
+bench.instalar_fakes(main, SimpleNamespace(latencia_sheets=0, latencia_calendar=0, latencia_llm=0, taxa_429=0),
+                     bench.gerar_catalogo(500), bench.Contador())
+main.calendar_service = main._modelo = None
+main.backend_estoque.iniciar()
+pronto = time.perf_counter()
+carregados = [m for m in MODULOS if m in sys.modules]
+t = time.perf_counter()
+main.obter_modelo()
+gemini = time.perf_counter() - t
+main.backend_estoque.encerrar()
+main.memoria_usuarios.encerrar()
+print(json.dumps({"import_s": importado - inicio, "pronto_s": pronto - inicio, "carregados": carregados, "primeiro_gemini_s": gemini}))
+"""
+
+def chave_privada_descartavel() -> str:
+    """Chave RSA gerada na hora: o connect_to_google monta as credenciais de verdade na partida."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    chave = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return chave.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+def medir_partida(args) -> Dict[str, Any]:
+    pasta = preparar_ambiente(args)
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": "0:bench", "GEMINI_API_KEY": "bench", "CALENDAR_ID": "bench",
+        "GOOGLE_CREDENTIALS_JSON": json.dumps({
+            "type": "service_account", "client_email": "bench@bench.iam.gserviceaccount.com",
+            "private_key": chave_privada_descartavel(),
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }),
+        "ESTOQUE_DB": os.path.join(pasta, "partida.db"),
+        "PYTHONWARNINGS": "ignore",
+    })
+    script = f"MODULOS = {MODULOS_PESADOS!r}\n" + SCRIPT_PARTIDA
+    rodadas = []
+    for _ in range(args.partida):
+        saida = subprocess.run(
+            [sys.executable, "-c", script], env=env, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if saida.returncode != 0:
+            raise RuntimeError(f"Partida falhou:\n{saida.stderr}")
+        rodadas.append(json.loads(saida.stdout.strip().splitlines()[-1]))
+    return {
+        "rodadas": len(rodadas),
+        "backend": args.backend,
+        "import_ms": statistics.median(r["import_s"] for r in rodadas) * 1000,
+        "pronto_ms": statistics.median(r["pronto_s"] for r in rodadas) * 1000,
+        "primeiro_gemini_ms": statistics.median(r["primeiro_gemini_s"] for r in rodadas) * 1000,
+        "modulos_pesados_na_partida": sorted({m for r in rodadas for m in r["carregados"]}),
+    }
+
+def imprimir_relatorio_partida(r: Dict[str, Any]):
+    print("⏱️ Partida a frio")
+    print(f"   rodadas: {r['rodadas']} | backend: {r['backend']} (medianas)")
+    print(f"   import do main: {r['import_ms']:.0f} ms | pronto para o primeiro poll: {r['pronto_ms']:.0f} ms")
+    print(f"   primeiro uso do Gemini (import + configure, sem rede): {r['primeiro_gemini_ms']:.0f} ms")
+    pesados = ", ".join(r["modulos_pesados_na_partida"]) or "nenhum"
+    print(f"   módulos pesados carregados antes do primeiro poll: {pesados}")
+
+# =========================
+# 🌐 Carga no webhook (bot real rodando localmente)
+# =========================
+def update_json(i: int, user_id: int, texto: str) -> Dict[str, Any]:
+    """Update do Telegram (formato da Bot API) com uma mensagem de texto privada."""
+    return {
+        "update_id": i + 1,
+        "message": {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Operador{user_id}"},
+            "text": texto,
+        },
+    }
+
+def carregar_updates(args) -> List[Dict[str, Any]]:
+    if args.updates:
+        with open(args.updates, "r", encoding="utf-8") as f:
+            return [json.loads(l) for l in f if l.strip()]
+    corpus = gerar_corpus(gerar_catalogo(args.produtos), args.mensagens, args.semente)
+    return [update_json(i, 1000 + i % args.usuarios, texto) for i, texto in enumerate(corpus)]
+
+async def carga_webhook(args) -> Dict[str, Any]:
+    import aiohttp
+
+    updates = carregar_updates(args)
+    semaforo = asyncio.Semaphore(args.concorrencia)
+    latencias: List[float] = []
+    status = Counter()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.segredo} if args.segredo else {}
+
+    async with aiohttp.ClientSession(headers=headers) as sessao:
+        async def enviar(update: Dict[str, Any]):
+            async with semaforo:
+                inicio = time.perf_counter()
+                async with sessao.post(args.webhook, json=update) as resp:
+                    await resp.read()
+                    status[resp.status] += 1
+                latencias.append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(enviar(u) for u in updates))
+        duracao = time.perf_counter() - inicio
+
+    return {
+        "updates": len(updates),
+        "concorrencia": args.concorrencia,
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+        "req_por_s": len(updates) / duracao if duracao else 0.0,
+        "status": dict(status),
+    }
+
+def imprimir_relatorio_webhook(r: Dict[str, Any]):
+    print("🌐 Carga no webhook")
+    print(f"   updates: {r['updates']} | concorrência: {r['concorrencia']} | status HTTP: {r['status']}")
+    print(f"   latência de confirmação p50: {r['p50_ms']:.1f} ms | p99: {r['p99_ms']:.1f} ms | vazão: {r['req_por_s']:.1f} req/s")
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark offline do ESTOQUE BOT (sem credenciais).")
+    ap.add_argument("--mensagens", type=int, default=300)
+    ap.add_argument("--concorrencia", type=int, default=16, help="mensagens em voo ao mesmo tempo")
+    ap.add_argument("--usuarios", type=int, default=40, help="usuários Telegram simulados")
+    ap.add_argument("--produtos", type=int, default=500, help="tamanho do catálogo na aba Estoque")
+    ap.add_argument("--backend", choices=["sheets", "sqlite"], default="sheets")
+    ap.add_argument("--latencia-llm", type=float, default=0.05, help="segundos por send_message")
+    ap.add_argument("--latencia-sheets", type=float, default=0.02, help="segundos por chamada ao Sheets")
+    ap.add_argument("--latencia-calendar", type=float, default=0.02)
+    ap.add_argument("--latencia-telegram", type=float, default=0.005)
+    ap.add_argument("--taxa-429", type=float, default=0.0, help="fração das chamadas ao Sheets que respondem 429")
+    ap.add_argument("--ttl-cache", type=int, default=300)
+    ap.add_argument("--sem-atalho", action="store_true", help="desliga o atalho sem Gemini")
+    ap.add_argument("--semente", type=int, default=42)
+    ap.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    ap.add_argument("--verbose", action="store_true", help="mantém os logs do bot")
+    ap.add_argument("--estresse", type=int, default=0, help="N vendedores concorrentes (confere o saldo final)")
+    ap.add_argument("--operacoes", type=int, default=50, help="operações por vendedor no --estresse")
+    ap.add_argument("--produtos-estresse", type=int, default=3, help="produtos disputados no --estresse")
+    ap.add_argument("--busca", action="store_true", help="confere a resolução de nomes nas compras e consultas")
+    ap.add_argument("--partida", type=int, default=0, help="N rodadas medindo a partida a frio em processos novos")
+    ap.add_argument("--webhook", help="URL do webhook local: faz carga HTTP em vez do benchmark em processo")
+    ap.add_argument("--updates", help="arquivo JSONL com updates gravados do Telegram (modo --webhook)")
+    ap.add_argument("--segredo", default=os.getenv("WEBHOOK_SECRET", ""), help="valor do WEBHOOK_SECRET do bot")
+    return ap.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.webhook:
+        resultado = asyncio.run(carga_webhook(args))
+        relatorio = imprimir_relatorio_webhook
+    elif args.busca:
+        resultado = conferir_busca(args)
+        relatorio = imprimir_relatorio_busca
+    elif args.partida:
+        resultado = medir_partida(args)
+        relatorio = imprimir_relatorio_partida
+    elif args.estresse:
+        resultado = estresse(args)
+        relatorio = imprimir_relatorio_estresse
+    else:
+        resultado = executar(args)
+        relatorio = imprimir_relatorio
+    if args.json:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    else:
+        relatorio(resultado)
+    if resultado.get("divergencias") or resultado.get("falhas"):
+        sys.exit(1)
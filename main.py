@@ -3,19 +3,39 @@
 # Gemini 2.5 Flash + Telegram + Google Sheets + Google Calendar
 # ============================================================
 
+import time
+# Referência para medir o tempo até o primeiro poll: antes de qualquer outra importação
+INICIO_PROCESSO = time.perf_counter()
+
 # Bibliotecas (remova o !pip install)
 import os
 import json
 import datetime
 import traceback
 import asyncio
-from typing import Any, Dict
+import re
+import threading
+import weakref
+import glob
+import sqlite3
+import logging
+import contextlib
+import contextvars
+import sys
+import unicodedata
+import signal
+import heapq
+import itertools
+import random
+from abc import ABC, abstractmethod
+from collections import OrderedDict, Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Dict, List, Optional
 
-# Importações de terceiros
-import gspread
-from google.oauth2 import service_account 
-from googleapiclient.discovery import build
-import google.generativeai as genai
+# Importações de terceiros: gspread, googleapiclient e google.generativeai são importados
+# no primeiro uso (cliente_sheets, cliente_calendar, obter_modelo), para o bot começar a
+# receber mensagens sem pagar esse custo na partida; google-auth é leve e entra no connect_to_google
 
 # Importações do Telegram (Assíncronas)
 from telegram import Update
@@ -35,140 +55,1806 @@ from telegram.ext import (
 TOKEN_TELEGRAM = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 NOME_PLANILHA = os.getenv("NOME_PLANILHA", "EstoqueDepositoBebidas")
+PLANILHA_KEY = os.getenv("PLANILHA_KEY")  # Opcional: abrir pela chave evita a busca por nome no Drive
 CALENDAR_ID = os.getenv("CALENDAR_ID")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 
+# Tempo (segundos) que o cache da aba Estoque fica válido antes de recarregar do Sheets
+CACHE_ESTOQUE_TTL = int(os.getenv("CACHE_ESTOQUE_TTL", "300"))
+
+# Fila de escrita (write-behind) para o Sheets
+ESCRITA_FLUSH_MS = int(os.getenv("ESCRITA_FLUSH_MS", "500"))        # intervalo máximo entre flushes
+ESCRITA_FLUSH_LINHAS = int(os.getenv("ESCRITA_FLUSH_LINHAS", "20"))  # flush antecipado ao juntar N movimentações
+ESCRITA_JOURNAL = os.getenv("ESCRITA_JOURNAL", "/tmp/estoque_fila_escrita.jsonl")
+
+# Atalho sem Gemini para comandos simples de estoque ("saldo de X", "vendi 3 X")
+ATALHO_ATIVO = os.getenv("ATALHO_ATIVO", "1") not in ("0", "false", "False")
+
+# Backend do estoque: "sheets" (direto na planilha, com cache e fila de escrita)
+# ou "sqlite" (banco local como fonte da verdade, espelhado no Sheets em lote)
+ESTOQUE_BACKEND = os.getenv("ESTOQUE_BACKEND", "sheets").strip().lower()
+ESTOQUE_DB = os.getenv("ESTOQUE_DB", "/tmp/estoque.db")
+SYNC_INTERVALO_S = int(os.getenv("SYNC_INTERVALO_S", "30"))
+
+# Locks por produto: quantidade de faixas (produtos na mesma faixa dividem o lock)
+LOCKS_PRODUTO_FAIXAS = int(os.getenv("LOCKS_PRODUTO_FAIXAS", "64"))
+
+# Busca de produtos: pontuação mínima para aceitar um candidato e diferença
+# mínima entre o 1º e o 2º colocados para não precisar perguntar ao usuário
+BUSCA_SCORE_MINIMO = float(os.getenv("BUSCA_SCORE_MINIMO", "0.5"))
+BUSCA_MARGEM_AMBIGUIDADE = float(os.getenv("BUSCA_MARGEM_AMBIGUIDADE", "0.08"))
+
+# Tamanho dos pools de threads por backend (as chamadas síncronas saem do event loop)
+POOL_LLM_WORKERS = int(os.getenv("POOL_LLM_WORKERS", "8"))
+POOL_SHEETS_WORKERS = int(os.getenv("POOL_SHEETS_WORKERS", "4"))
+POOL_CALENDAR_WORKERS = int(os.getenv("POOL_CALENDAR_WORKERS", "2"))
+POOL_MEMORIA_WORKERS = int(os.getenv("POOL_MEMORIA_WORKERS", "2"))
+# Quantas mensagens (de usuários diferentes) o Telegram processa ao mesmo tempo
+MAX_UPDATES_CONCORRENTES = int(os.getenv("MAX_UPDATES_CONCORRENTES", "32"))
+
+# Modo de execução: "polling" (padrão, worker) ou "webhook" (servidor HTTP na PORT)
+MODO_EXECUCAO = os.getenv("MODO_EXECUCAO", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # URL pública; vazio = não registra no Telegram (teste local)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # conferido no header X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONCORRENTES = int(os.getenv("WEBHOOK_MAX_CONCORRENTES", "32"))
+
+# Cotas das APIs Google (requisições por minuto por usuário; a service account conta como um usuário)
+COTA_SHEETS_LEITURA_MIN = int(os.getenv("COTA_SHEETS_LEITURA_MIN", "60"))
+COTA_SHEETS_ESCRITA_MIN = int(os.getenv("COTA_SHEETS_ESCRITA_MIN", "60"))
+COTA_CALENDAR_MIN = int(os.getenv("COTA_CALENDAR_MIN", "600"))
+# Novas tentativas em 429/5xx: espera exponencial com jitter (base * 2^n, limitada ao máximo)
+API_MAX_TENTATIVAS = int(os.getenv("API_MAX_TENTATIVAS", "5"))
+API_BACKOFF_BASE_S = float(os.getenv("API_BACKOFF_BASE_S", "1.0"))
+API_BACKOFF_MAX_S = float(os.getenv("API_BACKOFF_MAX_S", "32"))
+
+# Observabilidade
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+PORT = int(os.getenv("PORT", "0"))                                   # /metrics e /healthz (0 = desligado)
+PROFILER_ATIVO = os.getenv("PROFILER", "0") in ("1", "true", "True")  # profiler por amostragem
+PROFILER_INTERVALO_MS = int(os.getenv("PROFILER_INTERVALO_MS", "10"))
+PROFILER_SAIDA = os.getenv("PROFILER_SAIDA", "/tmp/estoque_profile.txt")
+
 # Paths internos
 ABA_ESTOQUE = "Estoque"
 ABA_MOV = "Movimentacoes"
-MEMORY_FOLDER = "/tmp/memory_users"
+MEMORY_FOLDER = os.getenv("MEMORY_FOLDER", "/tmp/memory_users")
+MEMORY_DB = os.path.join(MEMORY_FOLDER, "memoria.db")
+MEMORIA_LRU = int(os.getenv("MEMORIA_LRU", "256"))              # usuários mantidos quentes em memória
+MEMORIA_FLUSH_MS = int(os.getenv("MEMORIA_FLUSH_MS", "1000"))   # intervalo de gravação no SQLite
+MAX_SESSOES = int(os.getenv("MAX_SESSOES", "200"))              # chats Gemini mantidos em memória
+SESSAO_IDLE_S = int(os.getenv("SESSAO_IDLE_S", "1800"))         # sessão ociosa por mais tempo é descartada
+HISTORICO_MAX_TOKENS = int(os.getenv("HISTORICO_MAX_TOKENS", "4000"))      # orçamento do histórico de cada chat
+HISTORICO_TURNOS_MINIMOS = int(os.getenv("HISTORICO_TURNOS_MINIMOS", "2"))  # últimas trocas nunca compactadas
 
-# Variáveis Globais de Conexão (Inicializadas em connect_to_google)
+# Aquece os clientes Google/Gemini numa thread logo depois do primeiro poll
+AQUECER_CLIENTES = os.getenv("AQUECER_CLIENTES", "1") not in ("0", "false", "False")
+
+# Variáveis Globais de Conexão (criadas no primeiro uso a partir do que connect_to_google validou)
 gc = None
 calendar_service = None
+credenciais_google = None
 
-# 1. Checa se as variáveis críticas estão definidas
-if not all([TOKEN_TELEGRAM, GEMINI_API_KEY, GOOGLE_CREDENTIALS_JSON, CALENDAR_ID]):
-    raise ValueError("❌ ERRO DE CONFIGURAÇÃO: Verifique as variáveis de ambiente (TELEGRAM_TOKEN, GEMINI_API_KEY, CALENDAR_ID, GOOGLE_CREDENTIALS_JSON) no Render.")
+# 1. Checa se as variáveis críticas estão definidas (chamada em main(), para o módulo
+#    poder ser importado sem credenciais, ex.: pelo bench.py)
+def verificar_configuracao():
+    if not all([TOKEN_TELEGRAM, GEMINI_API_KEY, GOOGLE_CREDENTIALS_JSON, CALENDAR_ID]):
+        raise ValueError("❌ ERRO DE CONFIGURAÇÃO: Verifique as variáveis de ambiente (TELEGRAM_TOKEN, GEMINI_API_KEY, CALENDAR_ID, GOOGLE_CREDENTIALS_JSON) no Render.")
+    if MODO_EXECUCAO not in ("polling", "webhook"):
+        raise ValueError(f"❌ MODO_EXECUCAO inválido: '{MODO_EXECUCAO}'. Use 'polling' ou 'webhook'.")
 
 os.makedirs(MEMORY_FOLDER, exist_ok=True)
 
+log = logging.getLogger("estoque_bot")
+
+# =========================
+# 📊 Métricas, tracing por etapa e profiler
+# =========================
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metricas:
+    """Contadores e histogramas em memória, exportados no formato texto do Prometheus."""
+
+    def __init__(self, buckets=BUCKETS_SEGUNDOS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._contadores: Dict[tuple, float] = {}
+        self._histogramas: Dict[tuple, List[float]] = {}  # chave -> contagens por bucket + [soma, total]
+        self._gauges: Dict[str, Any] = {}
+        self._ajuda: Dict[str, str] = {}
+
+    @staticmethod
+    def _chave(nome: str, labels: Dict[str, Any]) -> tuple:
+        return (nome, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def descrever(self, nome: str, ajuda: str):
+        self._ajuda[nome] = ajuda
+
+    def contar(self, nome: str, valor: float = 1.0, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0.0) + valor
+
+    def observar(self, nome: str, valor: float, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            h = self._histogramas.get(chave)
+            if h is None:
+                h = self._histogramas[chave] = [0.0] * (len(self.buckets) + 2)
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    h[i] += 1
+            h[-2] += valor
+            h[-1] += 1
+
+    def resumo(self, nome: str) -> Dict[str, tuple]:
+        """(total, soma) de cada série de um histograma, com os labels como texto."""
+        with self._lock:
+            return {
+                ",".join(f"{k}={v}" for k, v in pares): (h[-1], h[-2])
+                for (n, pares), h in self._histogramas.items() if n == nome
+            }
+
+    def gauge(self, nome: str, funcao, ajuda: str = ""):
+        """Valor lido na hora da coleta (ex.: tamanho de fila)."""
+        self._gauges[nome] = funcao
+        if ajuda:
+            self.descrever(nome, ajuda)
+
+    @staticmethod
+    def _labels(pares, extra: str = "") -> str:
+        itens = [f'{k}="{v}"' for k, v in pares]
+        if extra:
+            itens.append(extra)
+        return "{" + ",".join(itens) + "}" if itens else ""
+
+    def texto_prometheus(self) -> str:
+        linhas: List[str] = []
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {k: list(v) for k, v in self._histogramas.items()}
+        vistos = set()
+
+        def cabecalho(nome: str, tipo: str):
+            if nome not in vistos:
+                vistos.add(nome)
+                if nome in self._ajuda:
+                    linhas.append(f"# HELP {nome} {self._ajuda[nome]}")
+                linhas.append(f"# TYPE {nome} {tipo}")
+
+        for (nome, pares), valor in sorted(contadores.items()):
+            cabecalho(nome, "counter")
+            linhas.append(f"{nome}{self._labels(pares)} {valor:g}")
+        for (nome, pares), h in sorted(histogramas.items()):
+            cabecalho(nome, "histogram")
+            for i, limite in enumerate(self.buckets):
+                le = 'le="%g"' % limite
+                linhas.append(f"{nome}_bucket{self._labels(pares, le)} {h[i]:g}")
+            le_inf = 'le="+Inf"'
+            linhas.append(f"{nome}_bucket{self._labels(pares, le_inf)} {h[-1]:g}")
+            linhas.append(f"{nome}_sum{self._labels(pares)} {h[-2]:.6f}")
+            linhas.append(f"{nome}_count{self._labels(pares)} {h[-1]:g}")
+        for nome, funcao in sorted(self._gauges.items()):
+            try:
+                valor = float(funcao())
+            except Exception:
+                continue
+            cabecalho(nome, "gauge")
+            linhas.append(f"{nome} {valor:g}")
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+metricas.descrever("estoque_etapa_segundos", "Duração de cada etapa do processamento de uma mensagem.")
+metricas.descrever("estoque_mensagem_segundos", "Duração total do processamento de uma mensagem.")
+metricas.descrever("estoque_mensagens_total", "Mensagens processadas, por caminho (atalho, llm, erro).")
+metricas.descrever("estoque_sheets_chamadas_total", "Chamadas à API do Sheets, por aba e operação.")
+metricas.descrever("estoque_sheets_segundos", "Duração das chamadas à API do Sheets.")
+metricas.descrever("estoque_pool_espera_segundos", "Tempo de espera na fila do pool de threads de cada backend.")
+
+# Etapas da mensagem em andamento (propagado para as threads via contextvars)
+_trace_atual: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar("trace_atual", default=None)
+
+@contextlib.contextmanager
+def medir(etapa: str, **labels):
+    """Cronometra uma etapa: alimenta o histograma e o trace da mensagem atual (em ms)."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        metricas.observar("estoque_etapa_segundos", duracao, etapa=etapa, **labels)
+        trace = _trace_atual.get()
+        if trace is not None:
+            chave = ":".join([etapa, *map(str, labels.values())])
+            trace[chave] = round(trace.get(chave, 0.0) + duracao * 1000, 2)
+
+class ProfilerAmostragem:
+    """
+    Profiler por amostragem (ligado com PROFILER=1): a cada intervalo lê a pilha de todas
+    as threads e acumula pilhas "colapsadas" (formato do flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, intervalo_ms: int, saida: str):
+        self.intervalo = intervalo_ms / 1000.0
+        self.saida = saida
+        self.pilhas: "Counter[str]" = Counter()
+        self.amostras = 0
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _amostrar(self):
+        proprio = threading.get_ident()
+        while not self._parar.wait(self.intervalo):
+            for ident, frame in sys._current_frames().items():
+                if ident == proprio:
+                    continue
+                partes = []
+                while frame is not None:
+                    codigo = frame.f_code
+                    partes.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+                    frame = frame.f_back
+                self.pilhas[";".join(reversed(partes))] += 1
+            self.amostras += 1
+
+    def iniciar(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._amostrar, name="profiler", daemon=True)
+            self._thread.start()
+            log.info(f"🔬 Profiler por amostragem ligado ({self.intervalo * 1000:.0f} ms).")
+
+    def texto(self) -> str:
+        return "".join(f"{pilha} {n}\n" for pilha, n in self.pilhas.most_common())
+
+    def encerrar(self):
+        if self._thread is None:
+            return
+        self._parar.set()
+        self._thread.join()
+        self._thread = None
+        with open(self.saida, "w", encoding="utf-8") as f:
+            f.write(self.texto())
+        log.info(f"🔬 Profiler: {self.amostras} amostras gravadas em {self.saida}.")
+
+profiler = ProfilerAmostragem(PROFILER_INTERVALO_MS, PROFILER_SAIDA)
+
+def rota_observabilidade(caminho: str) -> Optional[tuple]:
+    """(corpo, content-type) das rotas /metrics, /healthz e /debug/profile; None se não for uma delas."""
+    if caminho == "/metrics":
+        return metricas.texto_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+    if caminho == "/healthz":
+        return "ok\n", "text/plain; charset=utf-8"
+    if caminho == "/debug/profile" and PROFILER_ATIVO:
+        return profiler.texto(), "text/plain; charset=utf-8"
+    return None
+
+class _HandlerMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        rota = rota_observabilidade(self.path)
+        if rota is None:
+            self.send_error(404)
+            return
+        corpo, tipo = rota
+        dados = corpo.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def log_message(self, format, *args):
+        pass  # sem log por scrape
+
+def iniciar_servidor_metricas(porta: int) -> Optional[ThreadingHTTPServer]:
+    """Sobe /metrics e /healthz numa thread (porta do PORT do render.yaml)."""
+    if not porta:
+        return None
+    servidor = ThreadingHTTPServer(("0.0.0.0", porta), _HandlerMetricas)
+    threading.Thread(target=servidor.serve_forever, name="metricas-http", daemon=True).start()
+    log.info(f"📊 Métricas em http://0.0.0.0:{porta}/metrics")
+    return servidor
+
+# =========================
+# 🚦 Cotas das APIs Google (token bucket, prioridade e backoff)
+# =========================
+# Quem espera a cota: leituras passam na frente de escritas, e escritas do usuário
+# passam na frente da sincronização em segundo plano (fila de escrita, espelho do SQLite)
+PRIORIDADE_LEITURA = 0
+PRIORIDADE_ESCRITA = 1
+PRIORIDADE_SEGUNDO_PLANO = 2
+
+class BaldeCota:
+    """
+    Token bucket de uma cota por minuto. A rajada é 1/10 da cota e a reposição é o
+    restante dividido pelo minuto, então nenhuma janela de 60 s passa da cota.
+    Quem chega espera numa fila ordenada por (prioridade, ordem de chegada).
+    """
+
+    def __init__(self, nome: str, por_minuto: int):
+        self.nome = nome
+        self.capacidade = max(1.0, por_minuto / 10.0)
+        self.taxa = max(por_minuto - self.capacidade, 1.0) / 60.0   # tokens por segundo
+        self._tokens = self.capacidade
+        self._atualizado = time.monotonic()
+        self._cond = threading.Condition()
+        self._fila: List[tuple] = []
+        self._ordem = itertools.count()
+        self.chamadas = 0
+        self.limitadas = 0
+        self.espera_total = 0.0
+        self.retentativas = 0
+
+    def _repor(self):
+        agora = time.monotonic()
+        self._tokens = min(self.capacidade, self._tokens + (agora - self._atualizado) * self.taxa)
+        self._atualizado = agora
+
+    def adquirir(self, prioridade: int = PRIORIDADE_LEITURA) -> float:
+        """Bloqueia até haver token para esta chamada. Retorna quanto tempo esperou (s)."""
+        inicio = time.monotonic()
+        with self._cond:
+            vez = (prioridade, next(self._ordem))
+            heapq.heappush(self._fila, vez)
+            try:
+                while True:
+                    self._repor()
+                    if self._fila[0] == vez:
+                        if self._tokens >= 1.0:
+                            self._tokens -= 1.0
+                            break
+                        self._cond.wait((1.0 - self._tokens) / self.taxa)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._fila.remove(vez)
+                heapq.heapify(self._fila)
+                self._cond.notify_all()
+        espera = time.monotonic() - inicio
+        self.chamadas += 1
+        if espera > 0.001:
+            self.limitadas += 1
+            self.espera_total += espera
+            metricas.contar("estoque_cota_espera_segundos_total", espera, cota=self.nome)
+        return espera
+
+    def penalizar(self):
+        """Recebemos 429: zera o balde para todo mundo desacelerar, não só quem levou o erro."""
+        with self._cond:
+            self._repor()
+            self._tokens = min(self._tokens, 0.0)
+
+    def na_fila(self) -> int:
+        with self._cond:
+            return len(self._fila)
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            "fila": self.na_fila(),
+            "chamadas": self.chamadas,
+            "limitadas": self.limitadas,
+            "espera_s": round(self.espera_total, 2),
+            "retentativas": self.retentativas,
+        }
+
+COTAS = {
+    "sheets_leitura": BaldeCota("sheets_leitura", COTA_SHEETS_LEITURA_MIN),
+    "sheets_escrita": BaldeCota("sheets_escrita", COTA_SHEETS_ESCRITA_MIN),
+    "calendar": BaldeCota("calendar", COTA_CALENDAR_MIN),
+}
+metricas.descrever("estoque_cota_espera_segundos_total", "Tempo total esperando cota das APIs Google.")
+metricas.descrever("estoque_api_retentativas_total", "Novas tentativas após 429/5xx nas APIs Google.")
+
+def codigo_http(erro: Exception) -> Optional[int]:
+    """Status HTTP de um erro do gspread (APIError.code) ou do googleapiclient (HttpError.resp.status)."""
+    codigo = getattr(erro, "code", None)
+    if codigo is None:
+        codigo = getattr(getattr(erro, "resp", None), "status", None)
+    try:
+        return int(codigo) if codigo is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def erro_temporario(erro: Exception, idempotente: bool = True) -> bool:
+    """
+    429, 5xx, 403 de rate limit (Calendar) ou falha de rede: vale tentar de novo.
+    Chamadas não idempotentes (append, criar evento) só repetem em 429/403 de rate limit,
+    que são recusados antes de gravar; num 5xx ou timeout a linha pode já ter entrado.
+    """
+    codigo = codigo_http(erro)
+    if codigo == 429 or (codigo == 403 and "ratelimitexceeded" in str(erro).lower()):
+        return True
+    if not idempotente:
+        return False
+    if erro_de_rede(erro):
+        return True
+    return codigo is not None and 500 <= codigo < 600
+
+def erro_de_rede(erro: Exception) -> bool:
+    """
+    Conexão recusada/caída ou timeout. O gspread (via requests) lança exceções próprias,
+    que não herdam de ConnectionError/TimeoutError; requests importado só aqui, como o gspread.
+    """
+    if isinstance(erro, (ConnectionError, TimeoutError)):
+        return True
+    from requests.exceptions import ConnectionError as ErroConexaoRequests, Timeout
+    return isinstance(erro, (ErroConexaoRequests, Timeout))
+
+def chamar_com_cota(cota: BaldeCota, chamada, prioridade: int = PRIORIDADE_LEITURA, idempotente: bool = True):
+    """Espera a cota e executa chamada(); em erro temporário tenta de novo com backoff exponencial e jitter."""
+    for tentativa in range(API_MAX_TENTATIVAS):
+        cota.adquirir(prioridade)
+        try:
+            return chamada()
+        except Exception as e:
+            if tentativa == API_MAX_TENTATIVAS - 1 or not erro_temporario(e, idempotente):
+                raise
+            codigo = codigo_http(e)
+            if codigo in (403, 429):
+                cota.penalizar()
+            teto = min(API_BACKOFF_MAX_S, API_BACKOFF_BASE_S * (2 ** tentativa))
+            espera = teto / 2 + random.uniform(0, teto / 2)
+            cota.retentativas += 1
+            metricas.contar("estoque_api_retentativas_total", cota=cota.nome, codigo=codigo or "rede")
+            log.warning(f"⏳ {cota.nome}: erro temporário ({codigo or e}). Tentativa {tentativa + 2}/{API_MAX_TENTATIVAS} em {espera:.1f}s.")
+            time.sleep(espera)
+
+class VooUnico:
+    """Junta chamadas idênticas em andamento: quem chega durante a primeira recebe o mesmo resultado."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_voo: Dict[Any, Future] = {}
+        self.unidas = 0
+
+    def executar(self, chave, fn):
+        with self._lock:
+            futuro = self._em_voo.get(chave)
+            dono = futuro is None
+            if dono:
+                futuro = self._em_voo[chave] = Future()
+            else:
+                self.unidas += 1
+        if not dono:
+            return futuro.result()
+        try:
+            resultado = fn()
+            futuro.set_result(resultado)
+            return resultado
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+
+leituras_em_voo = VooUnico()
+
 # =========================
 # 🔑 Conexão Google (Sheets + Calendar) - SEM ARQUIVO
 # =========================
-def connect_to_google() -> bool:
-    global gc, calendar_service
-    SCOPES = [
-        'https://spreadsheets.google.com/feeds',
-        'https://www.googleapis.com/auth/drive',
-        'https://www.googleapis.com/auth/calendar.events'
-    ]
+SCOPES = [
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/calendar.events'
+]
+_credenciais_info: Optional[Dict[str, Any]] = None
+_lock_clientes = threading.RLock()
 
+def connect_to_google() -> bool:
+    """
+    Monta as credenciais da service account na partida: JSON ou private_key inválidos
+    derrubam o bot cedo. Os clientes (gspread, Calendar) só são criados no primeiro uso:
+    cliente_sheets() e cliente_calendar().
+    """
+    global _credenciais_info, credenciais_google
     try:
         creds_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-        creds = service_account.Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-        
-        # Inicializa variáveis globais de serviço
-        gc = gspread.authorize(creds)
-        calendar_service = build('calendar', 'v3', credentials=creds)
-        print("✅ Conectado ao Google (Sheets + Calendar) via Variavel de Ambiente.")
+        faltando = [c for c in ("client_email", "private_key", "token_uri") if not creds_info.get(c)]
+        if faltando:
+            raise ValueError(f"campos ausentes: {', '.join(faltando)}")
+        with _lock_clientes:
+            _credenciais_info = creds_info
+            credenciais_google = None
+            # google-auth é leve; a chave privada é lida aqui, não na primeira mensagem
+            credenciais()
+        log.info(f"✅ Credenciais Google carregadas ({creds_info['client_email']}); Sheets e Calendar conectam no primeiro uso.")
         return True
     except Exception as e:
-        print(f"❌ Erro ao conectar ao Google. Verifique a variável GOOGLE_CREDENTIALS_JSON: {e}")
+        log.error(f"❌ Erro ao conectar ao Google. Verifique a variável GOOGLE_CREDENTIALS_JSON: {e}")
         # Retorna False, mas permite que a exceção encerre a aplicação no Render
         raise
 
+def credenciais():
+    """Credenciais da service account (google-auth importado só aqui; o connect_to_google já chama na partida)."""
+    global credenciais_google
+    with _lock_clientes:
+        if credenciais_google is None:
+            if _credenciais_info is None:
+                raise RuntimeError("Conexão Google não inicializada.")
+            from google.oauth2 import service_account
+            credenciais_google = service_account.Credentials.from_service_account_info(_credenciais_info, scopes=SCOPES)
+        return credenciais_google
+
+def cliente_sheets():
+    """Cliente gspread, criado na primeira chamada ao Sheets."""
+    global gc
+    with _lock_clientes:
+        if gc is None:
+            import gspread
+            try:
+                gc = gspread.authorize(credenciais())
+            except RuntimeError:
+                raise RuntimeError("Conexão Google Sheets não inicializada.")
+        return gc
+
+def cliente_calendar():
+    """
+    Cliente do Calendar, criado no primeiro evento. static_discovery usa o documento de
+    descoberta que vem dentro do google-api-python-client (sem buscar na rede).
+    """
+    global calendar_service
+    with _lock_clientes:
+        if calendar_service is None:
+            from googleapiclient.discovery import build
+            calendar_service = build('calendar', 'v3', credentials=credenciais(), static_discovery=True, cache_discovery=False)
+        return calendar_service
+
+def reautenticar_sheets():
+    """Recria o cliente gspread com as credenciais já carregadas (token expirado/revogado)."""
+    global gc
+    import gspread
+    with _lock_clientes:
+        if credenciais_google is None:
+            raise RuntimeError("Conexão Google Sheets não inicializada.")
+        gc = gspread.authorize(credenciais_google)
+
+class RegistroPlanilha:
+    """
+    Mantém a planilha e as abas abertas entre as chamadas, evitando refazer
+    gc.open + sh.worksheet (requisições de metadados) a cada operação.
+    """
+
+    def __init__(self):
+        self._planilha = None
+        self._abas: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.chamadas_metadados = 0
+        self.chamadas_evitadas = 0
+        self.reconexoes = 0
+
+    def _abrir_planilha(self):
+        self.chamadas_metadados += 1
+        COTAS["sheets_leitura"].adquirir(PRIORIDADE_LEITURA)
+        try:
+            if PLANILHA_KEY:
+                return cliente_sheets().open_by_key(PLANILHA_KEY)
+            return cliente_sheets().open(NOME_PLANILHA)
+        except Exception as e:
+            raise RuntimeError(f"Não foi possível abrir a planilha '{PLANILHA_KEY or NOME_PLANILHA}'. Verifique o nome e as permissões: {e}")
+
+    def aba(self, nome_aba: str):
+        from gspread import WorksheetNotFound
+        with self._lock:
+            ws = self._abas.get(nome_aba)
+            if ws is not None:
+                # Reaproveitar a aba poupa o gc.open e o sh.worksheet
+                self.chamadas_evitadas += 2
+                return ws
+            if self._planilha is None:
+                self._planilha = self._abrir_planilha()
+            else:
+                self.chamadas_evitadas += 1
+            self.chamadas_metadados += 1
+            COTAS["sheets_leitura"].adquirir(PRIORIDADE_LEITURA)
+            try:
+                ws = self._planilha.worksheet(nome_aba)
+            except WorksheetNotFound:
+                raise RuntimeError(f"Aba '{nome_aba}' não encontrada. Crie manualmente: {ABA_ESTOQUE} e {ABA_MOV}.")
+            self._abas[nome_aba] = ws
+            return ws
+
+    def invalidar(self):
+        with self._lock:
+            self._planilha = None
+            self._abas.clear()
+            self.reconexoes += 1
+
+    def estatisticas(self) -> Dict[str, int]:
+        return {
+            "chamadas_metadados": self.chamadas_metadados,
+            "chamadas_evitadas": self.chamadas_evitadas,
+            "reconexoes": self.reconexoes,
+        }
+
+registro_planilha = RegistroPlanilha()
+
 def abrir_aba(nome_aba: str):
-    """Abre a aba (Worksheet) e lança erro informativo se não existir."""
-    if not gc:
-        raise RuntimeError("Conexão Google Sheets não inicializada.")
+    """Devolve a aba (Worksheet) já aberta e lança erro informativo se não existir."""
+    cliente_sheets()
+    return registro_planilha.aba(nome_aba)
+
+# Operações de leitura: usam a cota de leitura e chamadas iguais em andamento são unidas
+OPERACOES_LEITURA = {"get_all_records", "get_all_values", "col_values"}
+# Operações que acrescentam linhas: repetir depois de um 5xx/timeout pode duplicar a linha
+OPERACOES_NAO_IDEMPOTENTES = {"append_row", "append_rows"}
+
+def executar_na_aba(nome_aba: str, operacao, nome_operacao: str = "outra", prioridade: Optional[int] = None):
+    """
+    Executa operacao(ws) na aba respeitando a cota do Sheets (ver chamar_com_cota).
+    Em 401 (credencial expirada) ou 404 (planilha/aba recriada) renova credenciais e
+    handles e tenta uma única vez de novo. nome_operacao é o rótulo das métricas e
+    decide a cota (leitura ou escrita) e se um 5xx/timeout pode ser repetido (appends não);
+    prioridade padrão: leitura ou escrita do usuário.
+    """
+    leitura = nome_operacao in OPERACOES_LEITURA
+    idempotente = nome_operacao not in OPERACOES_NAO_IDEMPOTENTES
+    cota = COTAS["sheets_leitura" if leitura else "sheets_escrita"]
+    if prioridade is None:
+        prioridade = PRIORIDADE_LEITURA if leitura else PRIORIDADE_ESCRITA
+
+    def chamada():
+        try:
+            return operacao(abrir_aba(nome_aba))
+        except Exception as e:
+            codigo = codigo_http(e)
+            if codigo not in (401, 404):
+                raise
+            log.warning(f"🔁 Sheets respondeu {codigo} na aba '{nome_aba}'. Reabrindo planilha...")
+            if codigo == 401:
+                reautenticar_sheets()
+            registro_planilha.invalidar()
+            return operacao(abrir_aba(nome_aba))
+
+    inicio = time.perf_counter()
+    metricas.contar("estoque_sheets_chamadas_total", aba=nome_aba, operacao=nome_operacao)
     try:
-        sh = gc.open(NOME_PLANILHA)
-    except Exception as e:
-        raise RuntimeError(f"Não foi possível abrir a planilha '{NOME_PLANILHA}'. Verifique o nome e as permissões: {e}")
+        if leitura:
+            return leituras_em_voo.executar((nome_aba, nome_operacao), lambda: chamar_com_cota(cota, chamada, prioridade))
+        return chamar_com_cota(cota, chamada, prioridade, idempotente)
+    finally:
+        duracao = time.perf_counter() - inicio
+        metricas.observar("estoque_sheets_segundos", duracao, aba=nome_aba, operacao=nome_operacao)
+        trace = _trace_atual.get()
+        if trace is not None:
+            chave = f"sheets:{nome_operacao}"
+            trace[chave] = round(trace.get(chave, 0.0) + duracao * 1000, 2)
+
+# =========================
+# 🔎 Índice de produtos (sem acento/caixa, tokens + trigramas)
+# =========================
+def dobrar_texto(texto: str) -> str:
+    """Minúsculas, sem acentos e só letras/dígitos separados por espaço ('Guaraná 2L' -> 'guarana 2l')."""
+    sem_acento = unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", sem_acento.lower()).split())
+
+def trigramas(token: str) -> set:
+    t = f"  {token} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+def _dice(a: set, b: set) -> float:
+    return 2.0 * len(a & b) / (len(a) + len(b)) if a and b else 0.0
+
+class IndiceProdutos:
+    """
+    Índice invertido de nomes de produto: token exato e trigramas -> chaves.
+    Atualizado incrementalmente; a busca pontua só os candidatos vindos do índice
+    (cobertura dos termos da consulta + similaridade de trigramas), sem varrer o catálogo.
+    """
+
+    MAX_CANDIDATOS = 300
+    MAX_PONTUADOS = 25
+
+    def __init__(self):
+        self._produtos: Dict[str, Dict[str, Any]] = {}   # chave -> nome, tokens, trigramas, ordem
+        self._por_dobrado: Dict[str, str] = {}
+        self._por_token: Dict[str, set] = {}
+        self._por_trigrama: Dict[str, set] = {}
+        self._lock = threading.RLock()
+
+    def adicionar(self, chave: str, nome: str, ordem: int = 0):
+        dobrado = dobrar_texto(nome)
+        tokens = dobrado.split()
+        tris = set().union(*(trigramas(t) for t in tokens)) if tokens else set()
+        with self._lock:
+            if chave in self._produtos:
+                self.remover(chave)
+            self._produtos[chave] = {"nome": nome, "tokens": tokens, "tris_token": {t: trigramas(t) for t in tokens}, "tris": tris, "ordem": ordem}
+            self._por_dobrado.setdefault(dobrado, chave)
+            for t in tokens:
+                self._por_token.setdefault(t, set()).add(chave)
+            for tri in tris:
+                self._por_trigrama.setdefault(tri, set()).add(chave)
+
+    def remover(self, chave: str):
+        with self._lock:
+            prod = self._produtos.pop(chave, None)
+            if prod is None:
+                return
+            dobrado = " ".join(prod["tokens"])
+            if self._por_dobrado.get(dobrado) == chave:
+                del self._por_dobrado[dobrado]
+            for t in prod["tokens"]:
+                self._por_token.get(t, set()).discard(chave)
+            for tri in prod["tris"]:
+                self._por_trigrama.get(tri, set()).discard(chave)
+
+    def __len__(self) -> int:
+        return len(self._produtos)
+
+    def _candidatos(self, tokens: List[str], tris: set) -> set:
+        # 1) Produtos que têm todos os termos exatos da consulta
+        conjuntos = [self._por_token.get(t) for t in tokens]
+        if all(conjuntos):
+            candidatos = set.intersection(*conjuntos)
+            if candidatos:
+                return candidatos
+        # 2) Erro de digitação/termo parcial: trigramas mais raros da consulta primeiro.
+        #    Trigramas que não existem no catálogo (palavra desconhecida) não gastam as 6 vagas
+        listas = sorted((l for l in (self._por_trigrama.get(tri) for tri in tris) if l), key=len)
+        candidatos: set = set()
+        for lista in listas[:6]:
+            candidatos.update(lista)
+            if len(candidatos) >= self.MAX_CANDIDATOS:
+                break
+        return candidatos
+
+    def _pontuar(self, tokens: List[str], tris_consulta: Dict[str, set], tris: set, prod: Dict[str, Any]) -> float:
+        cobertura = 0.0
+        for t in tokens:
+            melhor = 0.0
+            for pt in prod["tokens"]:
+                if pt == t:
+                    melhor = 1.0
+                    break
+                if pt.startswith(t) and len(t) >= 2:
+                    melhor = max(melhor, 0.9)
+                else:
+                    melhor = max(melhor, _dice(tris_consulta[t], prod["tris_token"][pt]))
+            cobertura += melhor
+        cobertura /= len(tokens)
+        return 0.65 * cobertura + 0.35 * _dice(tris, prod["tris"])
+
+    def buscar(self, consulta: str, limite: int = 5) -> List[tuple]:
+        """Lista de (chave, nome, pontuação) ordenada da melhor para a pior."""
+        dobrado = dobrar_texto(consulta)
+        if not dobrado:
+            return []
+        with self._lock:
+            exata = self._por_dobrado.get(dobrado)
+            if exata is not None:
+                return [(exata, self._produtos[exata]["nome"], 1.0)]
+            tokens = dobrado.split()
+            tris_consulta = {t: trigramas(t) for t in tokens}
+            tris = set().union(*tris_consulta.values())
+            candidatos = self._candidatos(tokens, tris)
+            if len(candidatos) > self.MAX_PONTUADOS:
+                # Pré-filtro barato (interseção de conjuntos em C) antes da pontuação completa
+                candidatos = sorted(candidatos, key=lambda c: _dice(tris, self._produtos[c]["tris"]), reverse=True)[:self.MAX_PONTUADOS]
+            ranking = []
+            for chave in candidatos:
+                prod = self._produtos[chave]
+                ranking.append((self._pontuar(tokens, tris_consulta, tris, prod), -prod["ordem"], chave, prod["nome"]))
+        ranking.sort(reverse=True)
+        return [(chave, nome, round(score, 4)) for score, _, chave, nome in ranking[:limite]]
+
+    def cobre(self, consulta: str, chave: str) -> bool:
+        """Todo termo da consulta é um termo do produto (igual ou prefixo): 'skol lata' cobre 'Skol Lata 350ml'."""
+        with self._lock:
+            prod = self._produtos.get(chave)
+            if prod is None:
+                return False
+            return all(any(pt == t or (len(t) >= 2 and pt.startswith(t)) for pt in prod["tokens"])
+                       for t in dobrar_texto(consulta).split())
+
+    def resolver(self, consulta: str, escrita: bool = False) -> Dict[str, Any]:
+        """
+        Melhor chave para a consulta, ou ambiguo=True quando os primeiros colocados
+        estão próximos demais (o bot deve perguntar qual é). Com escrita=True só vale
+        nome exato ou termos cobertos; parecido não basta ('Skol Lata 600ml' não é
+        'Skol Lata 350ml'): volta ambíguo com os candidatos, para perguntar ou cadastrar.
+        """
+        ranking = [r for r in self.buscar(consulta) if r[2] >= BUSCA_SCORE_MINIMO]
+        if not ranking:
+            return {"chave": None, "candidatos": [], "ambiguo": False}
+        if escrita and ranking[0][2] < 1.0 and not self.cobre(consulta, ranking[0][0]):
+            return {"chave": None, "candidatos": [r[1] for r in ranking], "ambiguo": True}
+        proximos = [r for r in ranking if ranking[0][2] - r[2] < BUSCA_MARGEM_AMBIGUIDADE]
+        if ranking[0][2] < 1.0 and len(proximos) > 1:
+            return {"chave": None, "candidatos": [r[1] for r in proximos], "ambiguo": True}
+        return {"chave": ranking[0][0], "candidatos": [r[1] for r in ranking], "ambiguo": False}
+
+# =========================
+# 📦 Cache de Estoque (em memória, indexado por nome normalizado)
+# =========================
+def normalizar_nome(nome: str) -> str:
+    """Normaliza o nome do produto para servir de chave no cache."""
+    return " ".join(str(nome).strip().lower().split())
+
+def agora_str() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class CacheEstoque:
+    """
+    Tabela em memória da aba Estoque: nome normalizado -> produto, quantidade e linha na planilha.
+    Recarrega do Sheets quando o TTL expira ou via /recarregar; escritas locais atualizam no lugar.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._itens: Dict[str, Dict[str, Any]] = {}
+        self.indice = IndiceProdutos()
+        self._carregado_em = 0.0
+        self._ultima_linha = 1
+        self._lock = threading.RLock()
+        self.acertos = 0
+        self.recargas = 0
+
+    def _expirado(self) -> bool:
+        return not self._carregado_em or (time.monotonic() - self._carregado_em) > self.ttl
+
+    def recarregar(self) -> int:
+        """Baixa a aba Estoque inteira e reconstrói o índice. Retorna a quantidade de produtos."""
+        # Cache travado do começo ao fim: nenhum saldo é atualizado no _itens antigo durante a troca
+        with self._lock:
+            versao = fila_escrita.versao
+            rows = executar_na_aba(ABA_ESTOQUE, lambda ws: ws.get_all_records(), "get_all_records")
+            # Inclui o que flushes concluídos durante a leitura gravaram: a foto da planilha pode ser
+            # anterior a eles, e esses saldos já saíram da fila
+            pendentes = fila_escrita.saldos_pendentes(desde=versao)
+            itens = self._montar_itens(rows, pendentes)
+            indice = IndiceProdutos()
+            for chave, item in itens.items():
+                indice.adicionar(chave, item["produto"], item["linha"])
+            self._itens = itens
+            self.indice = indice
+            self._ultima_linha = len(rows) + 1
+            self._carregado_em = time.monotonic()
+            self.recargas += 1
+            return len(itens)
+
+    def _montar_itens(self, rows: List[Dict[str, Any]], pendentes: Dict[int, int]) -> Dict[str, Dict[str, Any]]:
+        """Linhas da aba -> itens do cache, com os saldos ainda na fila de escrita por cima."""
+        itens = {}
+        for idx, r in enumerate(rows, start=2):
+            nome = str(r.get("Produto","")).strip()
+            if not nome:
+                continue
+            try:
+                qtd = int(r.get("Quantidade",0))
+            except:
+                qtd = 0
+            # Em caso de nome duplicado, vale a primeira linha (mesmo comportamento da busca linear)
+            itens.setdefault(normalizar_nome(nome), {"produto": nome, "quantidade": qtd, "linha": idx})
+        # Saldos ainda na fila de escrita valem mais que o que veio da planilha
+        if pendentes:
+            for item in itens.values():
+                if item["linha"] in pendentes:
+                    item["quantidade"] = pendentes[item["linha"]]
+        return itens
+
+    def invalidar(self):
+        with self._lock:
+            self._carregado_em = 0.0
+
+    def _garantir(self):
+        with self._lock:
+            if self._expirado():
+                self.recarregar()
+            else:
+                self.acertos += 1
+
+    def resolver(self, produto: str, escrita: bool = False) -> Dict[str, Any]:
+        """Busca exata pelo nome normalizado; se não achar, o melhor candidato do índice (ou ambíguo)."""
+        chave = normalizar_nome(produto)
+        with self._lock:
+            self._garantir()
+            item = self._itens.get(chave)
+            if item is not None:
+                return {"item": dict(item), "candidatos": [item["produto"]], "ambiguo": False}
+            res = self.indice.resolver(produto, escrita)
+            item = self._itens.get(res["chave"]) if res["chave"] else None
+            return {"item": dict(item) if item else None, "candidatos": res["candidatos"], "ambiguo": res["ambiguo"]}
+
+    def buscar(self, produto: str) -> Optional[Dict[str, Any]]:
+        return self.resolver(produto)["item"]
+
+    @contextlib.contextmanager
+    def travado(self):
+        """Segura o cache (já carregado) durante várias leituras e escritas: todas veem o mesmo estoque."""
+        with self._lock:
+            self._garantir()
+            yield self
+
+    def atualizar_quantidade(self, produto: str, quantidade: int):
+        with self._lock:
+            item = self._itens.get(normalizar_nome(produto))
+            if item is not None:
+                item["quantidade"] = quantidade
+
+    def adicionar(self, produto: str, quantidade: int, linha: Optional[int] = None):
+        with self._lock:
+            if linha is None:
+                linha = self._ultima_linha + 1
+            self._ultima_linha = max(self._ultima_linha, linha)
+            chave = normalizar_nome(produto)
+            self._itens[chave] = {"produto": produto, "quantidade": quantidade, "linha": linha}
+            self.indice.adicionar(chave, produto, linha)
+
+    def __len__(self) -> int:
+        return len(self._itens)
+
+cache_estoque = CacheEstoque(CACHE_ESTOQUE_TTL)
+
+def linha_do_append(resposta) -> Optional[int]:
+    """Extrai o número da linha inserida a partir da resposta do append_row (ex.: 'Estoque!A12:C12')."""
     try:
-        ws = sh.worksheet(nome_aba)
-    except gspread.WorksheetNotFound:
-        raise RuntimeError(f"Aba '{nome_aba}' não encontrada. Crie manualmente: {ABA_ESTOQUE} e {ABA_MOV}.")
-    return ws
+        faixa = resposta["updates"]["updatedRange"]
+        m = re.search(r"![A-Z]+(\d+)", faixa)
+        return int(m.group(1)) if m else None
+    except Exception:
+        return None
+
+# =========================
+# 📝 Fila de escrita (write-behind) para Estoque e Movimentacoes
+# =========================
+class FilaEscrita:
+    """
+    Junta as escritas no Sheets e grava em lote numa thread própria:
+    saldos viram um único batch_update no Estoque e movimentações um append_rows.
+    Cada item vai para um journal local (fsync) antes de ser confirmado, e o
+    journal é reaplicado na inicialização caso o processo caia antes do flush.
+    """
+
+    def __init__(self, caminho_journal: str, intervalo_ms: int, max_linhas: int):
+        self.caminho_journal = caminho_journal
+        self.intervalo = intervalo_ms / 1000.0
+        self.max_linhas = max_linhas
+        self._saldos: Dict[int, List[Any]] = {}   # linha -> [quantidade, atualizado_em]
+        self._movs: List[List[Any]] = []
+        self._em_voo: Dict[int, List[Any]] = {}
+        self._lock = threading.Lock()
+        self._lock_flush = threading.Lock()
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._journal = None
+        self.flushes = 0
+        self.falhas = 0
+        self.versao = 0   # +1 a cada flush concluído (ver saldos_pendentes)
+        self._gravados: "deque[tuple]" = deque(maxlen=64)   # (versao, saldos) dos últimos flushes
+        self.saldos_gravados = 0
+        self.movs_gravadas = 0
+
+    # --- journal ---
+    def _abrir_journal(self):
+        if self._journal is None:
+            os.makedirs(os.path.dirname(self.caminho_journal) or ".", exist_ok=True)
+            self._journal = open(self.caminho_journal, "a", encoding="utf-8")
+
+    def _registrar(self, *registros: Dict[str, Any]):
+        self._abrir_journal()
+        for registro in registros:
+            self._journal.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _reescrever_journal(self):
+        """Reescreve o journal só com o que ainda está pendente (chamar com self._lock)."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        tmp = self.caminho_journal + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for linha, valores in {**self._em_voo, **self._saldos}.items():
+                f.write(json.dumps({"t": "saldo", "linha": linha, "valores": valores}, ensure_ascii=False) + "\n")
+            for mov in self._movs:
+                f.write(json.dumps({"t": "mov", "valores": mov}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.caminho_journal)
+
+    def _reaplicar_journal(self):
+        if not os.path.exists(self.caminho_journal):
+            return
+        with open(self.caminho_journal, "r", encoding="utf-8") as f:
+            for raw in f:
+                try:
+                    reg = json.loads(raw)
+                except ValueError:
+                    continue  # linha truncada por queda no meio da escrita
+                if reg.get("t") == "saldo":
+                    self._saldos[int(reg["linha"])] = reg["valores"]
+                elif reg.get("t") == "mov":
+                    self._movs.append(reg["valores"])
+        if self._saldos or self._movs:
+            log.info(f"♻️ Fila de escrita: {len(self._saldos)} saldos e {len(self._movs)} movimentações pendentes do journal.")
+
+    # --- API ---
+    def enfileirar_movimentacao(self, linha_mov: List[Any]):
+        with self._lock:
+            self._registrar({"t": "mov", "valores": linha_mov})
+            self._movs.append(list(linha_mov))
+            if len(self._movs) >= self.max_linhas:
+                self._acordar.set()
+
+    def enfileirar_lote(self, saldos: Dict[int, List[Any]], movs: List[List[Any]]):
+        """Vários saldos e movimentações de uma vez (um único fsync no journal)."""
+        with self._lock:
+            self._registrar(
+                *({"t": "saldo", "linha": linha, "valores": valores} for linha, valores in saldos.items()),
+                *({"t": "mov", "valores": mov} for mov in movs),
+            )
+            self._saldos.update(saldos)
+            self._movs.extend(list(mov) for mov in movs)
+            if len(self._movs) >= self.max_linhas:
+                self._acordar.set()
+
+    def saldos_pendentes(self, desde: Optional[int] = None) -> Dict[int, int]:
+        """Saldos na fila ou em voo; com desde=versao, também os gravados pelos flushes concluídos depois dela."""
+        with self._lock:
+            gravados = {}
+            if desde is not None:
+                for versao, saldos in self._gravados:
+                    if versao > desde:
+                        gravados.update(saldos)
+            return {linha: v[0] for linha, v in {**gravados, **self._em_voo, **self._saldos}.items()}
+
+    def pendentes(self) -> int:
+        with self._lock:
+            return len(self._saldos) + len(self._movs)
+
+    def flush(self, prioridade: int = PRIORIDADE_SEGUNDO_PLANO):
+        with self._lock_flush:
+            with self._lock:
+                saldos, self._saldos = self._saldos, {}
+                movs, self._movs = self._movs, []
+                self._em_voo = dict(saldos)
+            if not saldos and not movs:
+                return
+            falhou = saldos_ok = False
+            if saldos:
+                dados = [{"range": f"B{linha}:C{linha}", "values": [valores]} for linha, valores in sorted(saldos.items())]
+                try:
+                    executar_na_aba(ABA_ESTOQUE, lambda ws: ws.batch_update(dados, raw=False), "batch_update", prioridade)
+                    self.saldos_gravados += len(saldos)
+                    saldos_ok = True
+                except Exception as e:
+                    falhou = True
+                    log.warning(f"❌ Falha no batch_update do Estoque (vai tentar de novo): {e}")
+                    with self._lock:
+                        # Não sobrescreve um saldo mais novo enfileirado durante o flush
+                        for linha, valores in saldos.items():
+                            self._saldos.setdefault(linha, valores)
+            if movs:
+                try:
+                    executar_na_aba(ABA_MOV, lambda ws: ws.append_rows(movs), "append_rows", prioridade)
+                    self.movs_gravadas += len(movs)
+                except Exception as e:
+                    falhou = True
+                    log.warning(f"❌ Falha no append_rows de Movimentacoes (vai tentar de novo): {e}")
+                    with self._lock:
+                        self._movs[:0] = movs
+            with self._lock:
+                self._em_voo = {}
+                self.versao += 1
+                if saldos_ok:
+                    self._gravados.append((self.versao, saldos))
+                self._reescrever_journal()
+            if falhou:
+                self.falhas += 1
+            else:
+                self.flushes += 1
+
+    def _loop(self):
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(f"❌ Erro inesperado na fila de escrita: {e}")
+
+    def iniciar(self):
+        with self._lock:
+            self._reaplicar_journal()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="fila-escrita", daemon=True)
+            self._thread.start()
+
+    def encerrar(self):
+        """Para a thread e grava tudo o que ainda estiver na fila."""
+        self._parar.set()
+        self._acordar.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def estatisticas(self) -> Dict[str, int]:
+        return {
+            "pendentes": self.pendentes(),
+            "flushes": self.flushes,
+            "falhas": self.falhas,
+            "saldos_gravados": self.saldos_gravados,
+            "movs_gravadas": self.movs_gravadas,
+        }
+
+fila_escrita = FilaEscrita(ESCRITA_JOURNAL, ESCRITA_FLUSH_MS, ESCRITA_FLUSH_LINHAS)
+
+# =========================
+# 🗄️ Backends de armazenamento do estoque
+# =========================
+def linha_movimentacao(produto: str, quantidade: int, tipo: str, responsavel: str="", observacao: str="") -> List[Any]:
+    """Linha no formato da aba Movimentacoes: Data, Produto, Quantidade, Tipo, Responsável, Observação."""
+    return [agora_str(), produto, quantidade, tipo, responsavel or "", observacao or ""]
+
+class BackendEstoque(ABC):
+    """Interface usada pelas funções de negócio; cada backend decide onde o estoque vive.
+    Um backend sem algum método abstrato falha já ao ser criado (TypeError)."""
+
+    nome = ""
+
+    def buscar(self, produto: str) -> Optional[Dict[str, Any]]:
+        """Devolve {"produto", "quantidade"} do produto encontrado ou None."""
+        return self.resolver(produto)["item"]
+
+    @abstractmethod
+    def resolver(self, produto: str, escrita: bool = False) -> Dict[str, Any]:
+        """
+        {"item": produto ou None, "candidatos": [nomes], "ambiguo": bool}; ambíguo = perguntar ao usuário.
+        escrita=True: só nome exato ou termos cobertos resolvem (ver IndiceProdutos.resolver).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def aplicar_movimentacao(self, produto: str, delta: int, linha_mov: List[Any]) -> int:
+        """Soma delta ao saldo de um produto existente, registra a movimentação e devolve o novo saldo."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def adicionar_produto(self, produto: str, quantidade: int, linha_mov: List[Any]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def registrar_movimentacao(self, linha_mov: List[Any]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def aplicar_lote(self, pedidos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Aplica vários pedidos {"produto", "quantidade", "delta", "tipo", "tipo_novo", "responsavel",
+        "observacao"} contra o mesmo estoque. Devolve um resultado por pedido, na mesma ordem:
+        {"status": "sucesso", "produto", "novo_saldo", "novo"} ou {"status": "ambiguo", "candidatos"}.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def recarregar(self) -> int:
+        """Relê o estoque da planilha. Retorna a quantidade de produtos."""
+        raise NotImplementedError
+
+    def iniciar(self):
+        pass
+
+    def encerrar(self):
+        pass
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {}
+
+class BackendSheets(BackendEstoque):
+    """Planilha como fonte da verdade: leituras pelo CacheEstoque, escritas pela FilaEscrita."""
+
+    nome = "sheets"
+
+    def resolver(self, produto: str, escrita: bool = False) -> Dict[str, Any]:
+        return cache_estoque.resolver(produto, escrita)
+
+    def aplicar_movimentacao(self, produto: str, delta: int, linha_mov: List[Any]) -> int:
+        # Quem chama segura a faixa de lock do produto (atualizar_saldo e /lote), então
+        # ninguém soma em cima do mesmo saldo ao mesmo tempo
+        item = cache_estoque.buscar(produto)
+        if item is None:
+            raise RuntimeError(f"Produto '{produto}' não está no cache do estoque.")
+        novo = item["quantidade"] + delta
+        # Saldo, data e movimentação entram juntos na fila de escrita (um fsync no journal)
+        fila_escrita.enfileirar_lote({item["linha"]: [novo, linha_mov[0]]}, [linha_mov])
+        cache_estoque.atualizar_quantidade(item["produto"], novo)
+        return novo
+
+    def adicionar_produto(self, produto: str, quantidade: int, linha_mov: List[Any]):
+        # Síncrono: precisamos da linha criada para o cache
+        resp = executar_na_aba(ABA_ESTOQUE, lambda ws: ws.append_row([produto, quantidade, linha_mov[0]]), "append_row")
+        cache_estoque.adicionar(produto, quantidade, linha_do_append(resp))
+        fila_escrita.enfileirar_movimentacao(linha_mov)
+
+    def registrar_movimentacao(self, linha_mov: List[Any]):
+        fila_escrita.enfileirar_movimentacao(linha_mov)
+
+    def aplicar_lote(self, pedidos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        agora = agora_str()
+        resultados: List[Dict[str, Any]] = []
+        alterados: Dict[int, Dict[str, Any]] = {}   # linha -> item com o saldo já somado
+        novos: Dict[str, Dict[str, Any]] = {}       # nome normalizado -> produto a criar
+        movs: List[List[Any]] = []
+        with cache_estoque.travado():
+            for p in pedidos:
+                chave = normalizar_nome(p["produto"])
+                if chave in novos:
+                    item = novos[chave]
+                else:
+                    res = cache_estoque.resolver(p["produto"], escrita=True)
+                    if res["ambiguo"]:
+                        resultados.append({"status":"ambiguo","produto":p["produto"],"candidatos":res["candidatos"]})
+                        continue
+                    item = res["item"]
+                    if item is None:
+                        # Produto novo: entra com a quantidade informada (mesma regra do atualizar_saldo)
+                        item = novos[chave] = {"produto": p["produto"].strip(), "quantidade": p["quantidade"]}
+                        movs.append(linha_movimentacao(item["produto"], p["quantidade"], p["tipo_novo"], p["responsavel"], p["observacao"]))
+                        resultados.append({"status":"sucesso","produto":item["produto"],"novo_saldo":item["quantidade"],"novo":True})
+                        continue
+                    item = alterados.setdefault(item["linha"], item)
+                item["quantidade"] += p["delta"]
+                movs.append(linha_movimentacao(item["produto"], p["quantidade"], p["tipo"], p["responsavel"], p["observacao"]))
+                resultados.append({"status":"sucesso","produto":item["produto"],"novo_saldo":item["quantidade"],"novo":False})
+
+            if novos:
+                # Síncrono: precisamos das linhas criadas para o cache
+                resp = executar_na_aba(
+                    ABA_ESTOQUE, lambda ws: ws.append_rows([[i["produto"], i["quantidade"], agora] for i in novos.values()]), "append_rows"
+                )
+                primeira = linha_do_append(resp)
+                for n, item in enumerate(novos.values()):
+                    cache_estoque.adicionar(item["produto"], item["quantidade"], primeira + n if primeira else None)
+            for item in alterados.values():
+                cache_estoque.atualizar_quantidade(item["produto"], item["quantidade"])
+            fila_escrita.enfileirar_lote({linha: [item["quantidade"], agora] for linha, item in alterados.items()}, movs)
+        # Grava já: um batch_update no Estoque e um append_rows em Movimentacoes
+        fila_escrita.flush(PRIORIDADE_ESCRITA)
+        return resultados
+
+    def recarregar(self) -> int:
+        return cache_estoque.recarregar()
+
+    def iniciar(self):
+        fila_escrita.iniciar()
+
+    def encerrar(self):
+        fila_escrita.encerrar()
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            "produtos": len(cache_estoque),
+            "cache_acertos": cache_estoque.acertos,
+            "cache_recargas": cache_estoque.recargas,
+            **{f"fila_{k}": v for k, v in fila_escrita.estatisticas().items()},
+        }
+
+class BackendSQLite(BackendEstoque):
+    """
+    SQLite local como fonte da verdade. Cada movimentação é aplicada numa transação
+    (saldo + registro); uma thread espelha as mudanças nas abas Estoque/Movimentacoes
+    em lote (batch_update + append_rows) a cada SYNC_INTERVALO_S segundos.
+    """
+
+    nome = "sqlite"
+
+    def __init__(self, caminho_db: str, intervalo_sync_s: int):
+        self.caminho_db = caminho_db
+        self.intervalo_sync = intervalo_sync_s
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._lock_sync = threading.Lock()
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._indice: Optional[IndiceProdutos] = None
+        self.sincronizacoes = 0
+        self.falhas_sync = 0
+        self.produtos_sincronizados = 0
+        self.movs_sincronizadas = 0
+
+    def _conexao(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(os.path.dirname(self.caminho_db) or ".", exist_ok=True)
+                conn = sqlite3.connect(self.caminho_db, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS produtos (
+                        id INTEGER PRIMARY KEY,
+                        nome TEXT NOT NULL,
+                        nome_norm TEXT NOT NULL UNIQUE,
+                        quantidade INTEGER NOT NULL DEFAULT 0,
+                        atualizado_em TEXT NOT NULL,
+                        linha_planilha INTEGER,
+                        versao INTEGER NOT NULL DEFAULT 0,
+                        sincronizado INTEGER NOT NULL DEFAULT 0
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_produtos_pendentes ON produtos(id) WHERE sincronizado = 0;
+                    CREATE INDEX IF NOT EXISTS idx_produtos_linha ON produtos(linha_planilha);
+                    CREATE TABLE IF NOT EXISTS movimentacoes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        data TEXT NOT NULL,
+                        produto TEXT NOT NULL,
+                        quantidade INTEGER NOT NULL,
+                        tipo TEXT NOT NULL,
+                        responsavel TEXT NOT NULL DEFAULT '',
+                        observacao TEXT NOT NULL DEFAULT '',
+                        sincronizado INTEGER NOT NULL DEFAULT 0
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_mov_pendentes ON movimentacoes(id) WHERE sincronizado = 0;
+                    CREATE INDEX IF NOT EXISTS idx_mov_produto_data ON movimentacoes(produto, data);
+                    """
+                )
+                self._conn = conn
+            return self._conn
+
+    def _transacao(self, fn):
+        """Roda fn(conn) dentro de BEGIN IMMEDIATE/COMMIT (rollback em caso de erro)."""
+        conn = self._conexao()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                resultado = fn(conn)
+                conn.execute("COMMIT")
+                return resultado
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    # --- leitura ---
+    def _indice_produtos(self) -> IndiceProdutos:
+        """Índice de nomes montado a partir do banco na primeira busca (depois, incremental)."""
+        with self._lock:
+            if self._indice is None:
+                indice = IndiceProdutos()
+                for row in self._conexao().execute("SELECT id, nome, nome_norm, linha_planilha FROM produtos"):
+                    indice.adicionar(row["nome_norm"], row["nome"], row["linha_planilha"] or 1_000_000 + row["id"])
+                self._indice = indice
+            return self._indice
+
+    def resolver(self, produto: str, escrita: bool = False) -> Dict[str, Any]:
+        chave = normalizar_nome(produto)
+        vazio = {"item": None, "candidatos": [], "ambiguo": False}
+        if not chave:
+            return vazio
+        conn = self._conexao()
+        with self._lock:
+            row = conn.execute("SELECT nome, quantidade FROM produtos WHERE nome_norm = ?", (chave,)).fetchone()
+            if row is None:
+                res = self._indice_produtos().resolver(produto, escrita)
+                if res["ambiguo"] or not res["chave"]:
+                    return {"item": None, "candidatos": res["candidatos"], "ambiguo": res["ambiguo"]}
+                row = conn.execute("SELECT nome, quantidade FROM produtos WHERE nome_norm = ?", (res["chave"],)).fetchone()
+        if row is None:
+            return vazio
+        return {"item": {"produto": row["nome"], "quantidade": row["quantidade"]}, "candidatos": [row["nome"]], "ambiguo": False}
+
+    def contar_produtos(self) -> int:
+        conn = self._conexao()
+        with self._lock:
+            return conn.execute("SELECT COUNT(*) FROM produtos").fetchone()[0]
+
+    # --- escrita ---
+    @staticmethod
+    def _inserir_mov(conn: sqlite3.Connection, linha_mov: List[Any]):
+        conn.execute(
+            "INSERT INTO movimentacoes (data, produto, quantidade, tipo, responsavel, observacao) VALUES (?, ?, ?, ?, ?, ?)",
+            tuple(linha_mov[:6]),
+        )
+
+    @staticmethod
+    def _somar(conn: sqlite3.Connection, produto: str, delta: int, atualizado_em: str) -> int:
+        cur = conn.execute(
+            "UPDATE produtos SET quantidade = quantidade + ?, atualizado_em = ?, versao = versao + 1, sincronizado = 0 "
+            "WHERE nome_norm = ?",
+            (delta, atualizado_em, normalizar_nome(produto)),
+        )
+        if cur.rowcount == 0:
+            raise RuntimeError(f"Produto '{produto}' não existe no banco local.")
+        return conn.execute("SELECT quantidade FROM produtos WHERE nome_norm = ?", (normalizar_nome(produto),)).fetchone()[0]
+
+    @staticmethod
+    def _inserir_produto(conn: sqlite3.Connection, produto: str, quantidade: int, atualizado_em: str) -> int:
+        cur = conn.execute(
+            "INSERT INTO produtos (nome, nome_norm, quantidade, atualizado_em) VALUES (?, ?, ?, ?)",
+            (produto, normalizar_nome(produto), quantidade, atualizado_em),
+        )
+        return cur.lastrowid
+
+    def _indexar_novos(self, novos: List[tuple]):
+        with self._lock:
+            if self._indice is not None:
+                for produto, novo_id in novos:
+                    self._indice.adicionar(normalizar_nome(produto), produto, 1_000_000 + novo_id)
+
+    def aplicar_movimentacao(self, produto: str, delta: int, linha_mov: List[Any]) -> int:
+        def aplicar(conn):
+            novo = self._somar(conn, produto, delta, linha_mov[0])
+            self._inserir_mov(conn, linha_mov)
+            return novo
+        return self._transacao(aplicar)
+
+    def adicionar_produto(self, produto: str, quantidade: int, linha_mov: List[Any]):
+        def adicionar(conn):
+            novo_id = self._inserir_produto(conn, produto, quantidade, linha_mov[0])
+            self._inserir_mov(conn, linha_mov)
+            return novo_id
+        self._indexar_novos([(produto, self._transacao(adicionar))])
+
+    def registrar_movimentacao(self, linha_mov: List[Any]):
+        self._transacao(lambda conn: self._inserir_mov(conn, linha_mov))
+
+    def aplicar_lote(self, pedidos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        novos: List[tuple] = []
+
+        def aplicar(conn):
+            resultados = []
+            for p in pedidos:
+                # Dentro da transação: produtos criados por linhas anteriores do lote já aparecem aqui
+                res = self.resolver(p["produto"], escrita=True)
+                if res["ambiguo"]:
+                    resultados.append({"status":"ambiguo","produto":p["produto"],"candidatos":res["candidatos"]})
+                    continue
+                item = res["item"]
+                if item is None:
+                    nome = p["produto"].strip()
+                    linha = linha_movimentacao(nome, p["quantidade"], p["tipo_novo"], p["responsavel"], p["observacao"])
+                    novos.append((nome, self._inserir_produto(conn, nome, p["quantidade"], linha[0])))
+                    self._inserir_mov(conn, linha)
+                    resultados.append({"status":"sucesso","produto":nome,"novo_saldo":p["quantidade"],"novo":True})
+                    continue
+                linha = linha_movimentacao(item["produto"], p["quantidade"], p["tipo"], p["responsavel"], p["observacao"])
+                novo = self._somar(conn, item["produto"], p["delta"], linha[0])
+                self._inserir_mov(conn, linha)
+                resultados.append({"status":"sucesso","produto":item["produto"],"novo_saldo":novo,"novo":False})
+            return resultados
+
+        resultados = self._transacao(aplicar)
+        self._indexar_novos(novos)
+        # Espelha no Sheets sem esperar o intervalo (um batch_update + um append_rows)
+        self._acordar.set()
+        return resultados
+
+    # --- planilha <-> banco ---
+    def recarregar(self) -> int:
+        """
+        Traz para o banco as edições manuais da aba Estoque. Antes envia o que está pendente,
+        para não sobrescrever movimentações locais ainda não espelhadas.
+        """
+        self.sincronizar()
+        rows = executar_na_aba(ABA_ESTOQUE, lambda ws: ws.get_all_records(), "get_all_records")
+
+        def importar(conn):
+            for idx, r in enumerate(rows, start=2):
+                nome = str(r.get("Produto","")).strip()
+                if not nome:
+                    continue
+                try:
+                    qtd = int(r.get("Quantidade",0))
+                except:
+                    qtd = 0
+                conn.execute(
+                    "INSERT INTO produtos (nome, nome_norm, quantidade, atualizado_em, linha_planilha, sincronizado) "
+                    "VALUES (?, ?, ?, ?, ?, 1) "
+                    "ON CONFLICT(nome_norm) DO UPDATE SET quantidade = excluded.quantidade, linha_planilha = excluded.linha_planilha "
+                    "WHERE produtos.sincronizado = 1",
+                    (nome, normalizar_nome(nome), qtd, agora_str(), idx),
+                )
+        self._transacao(importar)
+        with self._lock:
+            self._indice = None  # remontado na próxima busca
+        return self.contar_produtos()
+
+    def _linhas_na_planilha(self) -> Dict[str, int]:
+        """Nome normalizado -> linha de cada produto da aba Estoque (a primeira, como no cache)."""
+        nomes = executar_na_aba(ABA_ESTOQUE, lambda ws: ws.col_values(1), "col_values", PRIORIDADE_SEGUNDO_PLANO)
+        linhas: Dict[str, int] = {}
+        for idx, nome in enumerate(nomes[1:], start=2):
+            if str(nome).strip():
+                linhas.setdefault(normalizar_nome(nome), idx)
+        return linhas
+
+    def _gravar_linhas(self, linhas: Dict[int, int], produtos=(), marcar: bool = False):
+        """Salva linha_planilha dos produtos (id -> linha) e, se pedido, marca como sincronizados."""
+        def gravar(conn):
+            for pid, linha in linhas.items():
+                conn.execute("UPDATE produtos SET linha_planilha = ? WHERE id = ?", (linha, pid))
+            if marcar:
+                for p in produtos:
+                    # Só marca se ninguém alterou o produto durante o envio
+                    conn.execute("UPDATE produtos SET sincronizado = 1 WHERE id = ? AND versao = ?", (p["id"], p["versao"]))
+        self._transacao(gravar)
+
+    def sincronizar(self):
+        """
+        Espelha no Sheets os produtos alterados e as movimentações ainda não enviadas.
+        Cada etapa grava seu resultado no banco assim que termina: uma falha depois do
+        append dos produtos novos não faz a próxima sincronização anexá-los de novo.
+        """
+        with self._lock_sync:
+            conn = self._conexao()
+            with self._lock:
+                produtos = conn.execute(
+                    "SELECT id, nome, quantidade, atualizado_em, linha_planilha, versao FROM produtos WHERE sincronizado = 0 ORDER BY id"
+                ).fetchall()
+                movs = conn.execute(
+                    "SELECT id, data, produto, quantidade, tipo, responsavel, observacao FROM movimentacoes "
+                    "WHERE sincronizado = 0 ORDER BY id"
+                ).fetchall()
+            if not produtos and not movs:
+                return
+            falhou = False
+            produtos = [dict(p) for p in produtos]
+            novos = [p for p in produtos if not p["linha_planilha"]]
+            try:
+                if novos:
+                    # Produto novo que já está na planilha (append anterior sem linha conhecida,
+                    # ou queda logo depois do append) só ganha a linha: nada de anexar de novo
+                    na_planilha = self._linhas_na_planilha()
+                    achados = {p["id"]: na_planilha[normalizar_nome(p["nome"])] for p in novos if normalizar_nome(p["nome"]) in na_planilha}
+                    if achados:
+                        self._gravar_linhas(achados)
+                        for p in novos:
+                            p["linha_planilha"] = achados.get(p["id"])
+                        novos = [p for p in novos if not p["linha_planilha"]]
+            except Exception as e:
+                falhou = True
+                log.warning(f"❌ Falha ao localizar produtos novos na planilha (vai tentar de novo): {e}")
+                novos = []
+
+            existentes = [p for p in produtos if p["linha_planilha"]]
+            if existentes:
+                dados = [
+                    {"range": f"B{p['linha_planilha']}:C{p['linha_planilha']}", "values": [[p["quantidade"], p["atualizado_em"]]]}
+                    for p in existentes
+                ]
+                try:
+                    executar_na_aba(ABA_ESTOQUE, lambda ws: ws.batch_update(dados, raw=False), "batch_update", PRIORIDADE_SEGUNDO_PLANO)
+                    self._gravar_linhas({}, existentes, marcar=True)
+                    self.produtos_sincronizados += len(existentes)
+                except Exception as e:
+                    falhou = True
+                    log.warning(f"❌ Falha ao atualizar saldos no Sheets (vai tentar de novo): {e}")
+
+            if novos:
+                try:
+                    resp = executar_na_aba(
+                        ABA_ESTOQUE,
+                        lambda ws: ws.append_rows([[p["nome"], p["quantidade"], p["atualizado_em"]] for p in novos]),
+                        "append_rows",
+                        PRIORIDADE_SEGUNDO_PLANO,
+                    )
+                except Exception as e:
+                    falhou = True
+                    log.warning(f"❌ Falha ao anexar produtos novos no Sheets (vai tentar de novo): {e}")
+                else:
+                    primeira = linha_do_append(resp)
+                    if primeira is not None:
+                        linhas_novas = {p["id"]: primeira + i for i, p in enumerate(novos)}
+                    else:
+                        # Resposta sem a faixa gravada: procura as linhas pelo nome
+                        try:
+                            na_planilha = self._linhas_na_planilha()
+                        except Exception as e:
+                            log.warning(f"⚠️ Produtos anexados, mas sem a linha na resposta (localiza na próxima sincronização): {e}")
+                            na_planilha = {}
+                        linhas_novas = {p["id"]: na_planilha[normalizar_nome(p["nome"])] for p in novos if normalizar_nome(p["nome"]) in na_planilha}
+                    # Grava as linhas já, antes de tentar as movimentações; sem linha, fica pendente
+                    # e a próxima sincronização encontra o produto pelo nome em vez de anexar de novo
+                    self._gravar_linhas(linhas_novas, [p for p in novos if p["id"] in linhas_novas], marcar=True)
+                    self.produtos_sincronizados += len(linhas_novas)
+
+            if movs:
+                try:
+                    executar_na_aba(ABA_MOV, lambda ws: ws.append_rows([list(m)[1:] for m in movs]), "append_rows", PRIORIDADE_SEGUNDO_PLANO)
+                    self._transacao(lambda conn: conn.executemany(
+                        "UPDATE movimentacoes SET sincronizado = 1 WHERE id = ?", [(m["id"],) for m in movs]))
+                    self.movs_sincronizadas += len(movs)
+                except Exception as e:
+                    falhou = True
+                    log.warning(f"❌ Falha ao anexar movimentações no Sheets (vai tentar de novo): {e}")
+
+            if falhou:
+                self.falhas_sync += 1
+            else:
+                self.sincronizacoes += 1
+
+    def _loop(self):
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo_sync)
+            self._acordar.clear()
+            try:
+                self.sincronizar()
+            except Exception as e:
+                log.exception(f"❌ Erro inesperado na sincronização do estoque: {e}")
+
+    def iniciar(self):
+        # Primeira execução: o banco nasce a partir da aba Estoque
+        if self.contar_produtos() == 0:
+            total = self.recarregar()
+            log.info(f"🗄️ Estoque local criado a partir da planilha: {total} produtos.")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="sync-estoque", daemon=True)
+            self._thread.start()
+
+    def encerrar(self):
+        self._parar.set()
+        self._acordar.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sincronizar()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def estatisticas(self) -> Dict[str, Any]:
+        conn = self._conexao()
+        with self._lock:
+            pend_prod = conn.execute("SELECT COUNT(*) FROM produtos WHERE sincronizado = 0").fetchone()[0]
+            pend_mov = conn.execute("SELECT COUNT(*) FROM movimentacoes WHERE sincronizado = 0").fetchone()[0]
+        return {
+            "produtos": self.contar_produtos(),
+            "pendentes_produtos": pend_prod,
+            "pendentes_movs": pend_mov,
+            "sincronizacoes": self.sincronizacoes,
+            "falhas_sync": self.falhas_sync,
+        }
+
+def criar_backend_estoque(nome: str) -> BackendEstoque:
+    if nome == "sheets":
+        return BackendSheets()
+    if nome == "sqlite":
+        return BackendSQLite(ESTOQUE_DB, SYNC_INTERVALO_S)
+    raise ValueError(f"❌ ESTOQUE_BACKEND inválido: '{nome}'. Use 'sheets' ou 'sqlite'.")
+
+backend_estoque = criar_backend_estoque(ESTOQUE_BACKEND)
 
 # =========================================================================
 # 🧩 Funções de negócio (Sheets + Calendar) - Lógica de Estoque e Agenda
 # =========================================================================
 
+class LocksPorProduto:
+    """
+    Locks em faixas: o nome normalizado escolhe um de N locks. Movimentações do mesmo
+    produto (ler saldo, somar, gravar) acontecem uma de cada vez; produtos diferentes
+    quase sempre caem em faixas diferentes e seguem em paralelo.
+    """
+
+    def __init__(self, faixas: int):
+        self._locks = [threading.Lock() for _ in range(max(1, faixas))]
+        self.esperas = 0
+
+    def _lock(self, produto: str) -> threading.Lock:
+        return self._locks[hash(normalizar_nome(produto)) % len(self._locks)]
+
+    @contextlib.contextmanager
+    def travar(self, produto: str):
+        lock = self._lock(produto)
+        if not lock.acquire(blocking=False):
+            self.esperas += 1
+            with medir("lock_produto"):
+                lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @contextlib.contextmanager
+    def travar_varios(self, produtos: List[str]):
+        """Trava as faixas de vários produtos, sempre em ordem crescente: dois lotes nunca se bloqueiam em cruz."""
+        faixas = sorted({hash(normalizar_nome(p)) % len(self._locks) for p in produtos})
+        travados = []
+        try:
+            for i in faixas:
+                lock = self._locks[i]
+                if not lock.acquire(blocking=False):
+                    self.esperas += 1
+                    with medir("lock_produto"):
+                        lock.acquire()
+                travados.append(lock)
+            yield
+        finally:
+            for lock in reversed(travados):
+                lock.release()
+
+locks_produto = LocksPorProduto(LOCKS_PRODUTO_FAIXAS)
+
+def mensagem_ambiguidade(produto: str, candidatos: List[str], escrita: bool = False) -> str:
+    if len(candidatos) == 1:
+        texto = f"Não encontrei '{produto}' exatamente; o mais parecido é {candidatos[0]}. É ele?"
+    else:
+        texto = f"Encontrei mais de um produto parecido com '{produto}': {', '.join(candidatos)}. Qual deles?"
+    return texto + (" Se for um produto novo, confirme para cadastrar." if escrita else "")
+
 def obter_saldo(produto: str) -> Dict[str, Any]:
     try:
-        ws = abrir_aba(ABA_ESTOQUE)
-        rows = ws.get_all_records()
-        for r in rows:
-            nome = str(r.get("Produto","")).strip()
-            if produto.strip().lower() in nome.lower():
-                try:
-                    qtd = int(r.get("Quantidade",0))
-                except:
-                    qtd = 0
-                return {"status":"sucesso","produto": nome,"quantidade":qtd}
+        res = backend_estoque.resolver(produto)
+        if res["ambiguo"]:
+            return {"status":"ambiguo","mensagem":mensagem_ambiguidade(produto, res["candidatos"]),"candidatos":res["candidatos"]}
+        item = res["item"]
+        if item:
+            return {"status":"sucesso","produto": item["produto"],"quantidade":item["quantidade"]}
         return {"status":"vazio","mensagem":f"O produto '{produto}' não foi encontrado no estoque."}
     except Exception as e:
         return {"status":"erro","mensagem": str(e)}
 
 def registrar_movimentacao(produto: str, quantidade: int, tipo: str, responsavel: str="", observacao: str="") -> Dict[str, Any]:
     try:
-        ws = abrir_aba(ABA_MOV)
-        agora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        linha = [agora, produto, quantidade, tipo, responsavel or "", observacao or ""]
-        ws.append_row(linha)
+        linha = linha_movimentacao(produto, quantidade, tipo, responsavel, observacao)
+        backend_estoque.registrar_movimentacao(linha)
         return {"status":"sucesso","mensagem":"Movimentação registrada","linha":linha}
     except Exception as e:
         return {"status":"erro","mensagem":str(e)}
 
-def atualizar_saldo(produto: str, quantidade: int, acao: str, responsavel: str="", observacao: str="") -> Dict[str, Any]:
-    """ acao: 'COMPRA' / 'ENTRADA' / 'VENDA' / 'SAIDA' / 'AJUSTE' """
+def classificar_acao(acao: str, quantidade: int) -> tuple:
+    """(delta no saldo, tipo da movimentação) para a ação pedida."""
+    act_upper = str(acao).strip().upper()
+    if act_upper in ["COMPRA","ENTRADA","IN","+"]:
+        return int(quantidade), "Entrada"
+    if act_upper in ["VENDA","SAIDA","OUT","-"]:
+        return -int(quantidade), "Saída"
+    return int(quantidade), acao.capitalize()
+
+def tipo_produto_novo(acao: str) -> str:
+    """Tipo da movimentação quando o produto ainda não existe no estoque."""
+    return "Entrada" if str(acao).strip().upper() in ["COMPRA","ENTRADA"] else acao
+
+def atualizar_saldo(produto: str, quantidade: int, acao: str, responsavel: str="", observacao: str="", produto_novo: bool=False) -> Dict[str, Any]:
+    """
+    acao: 'COMPRA' / 'ENTRADA' / 'VENDA' / 'SAIDA' / 'AJUSTE'.
+    produto_novo=True cadastra o produto mesmo havendo nomes parecidos (depois de o usuário confirmar).
+    """
     try:
-        ws = abrir_aba(ABA_ESTOQUE)
-        rows = ws.get_all_records()
         produto_norm = produto.strip()
-        encontrado = False
-        for idx, r in enumerate(rows, start=2):
-            nome = str(r.get("Produto","")).strip()
-            if produto_norm.lower() == nome.lower() or produto_norm.lower() in nome.lower():
-                encontrado = True
-                try:
-                    atual = int(r.get("Quantidade",0))
-                except:
-                    atual = 0
-                act_upper = str(acao).strip().upper()
-                if act_upper in ["COMPRA","ENTRADA","IN","+"]:
-                    novo = atual + int(quantidade)
-                    tipo_mov = "Entrada"
-                elif act_upper in ["VENDA","SAIDA","OUT","-"]:
-                    novo = atual - int(quantidade)
-                    tipo_mov = "Saída"
-                else:
-                    novo = atual + int(quantidade)
-                    tipo_mov = acao.capitalize()
-                
-                # Atualização do saldo no Sheets
-                ws.update_cell(idx, 2, novo)
-                ws.update_cell(idx, 3, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                
-                # Registro da Movimentação
-                mv = registrar_movimentacao(nome, int(quantidade), tipo_mov, responsavel, observacao)
+        res = backend_estoque.resolver(produto_norm, escrita=True)
+        if res["ambiguo"] and not produto_novo:
+            # Nada é gravado: o usuário precisa dizer qual dos produtos é (ou que é novo)
+            return {"status":"ambiguo","mensagem":mensagem_ambiguidade(produto_norm, res["candidatos"], escrita=True),"candidatos":res["candidatos"]}
+        item = res["item"]
+        # Um lock por produto em volta de ler saldo -> calcular -> gravar
+        with locks_produto.travar(item["produto"] if item else produto_norm):
+            if not item:
+                # Outro operador pode ter cadastrado o produto enquanto esperávamos o lock
+                res = backend_estoque.resolver(produto_norm, escrita=True)
+                if res["ambiguo"] and not produto_novo:
+                    return {"status":"ambiguo","mensagem":mensagem_ambiguidade(produto_norm, res["candidatos"], escrita=True),"candidatos":res["candidatos"]}
+                item = res["item"]
+            if item:
+                nome = item["produto"]
+                delta, tipo_mov = classificar_acao(acao, quantidade)
+
+                # Saldo + movimentação aplicados juntos pelo backend
+                linha = linha_movimentacao(nome, int(quantidade), tipo_mov, responsavel, observacao)
+                novo = backend_estoque.aplicar_movimentacao(nome, delta, linha)
+                mv = {"status":"sucesso","mensagem":"Movimentação registrada","linha":linha}
                 return {"status":"sucesso","produto":nome,"quantidade":int(quantidade),"novo_saldo":novo,"movimentacao":mv}
-        
-        # Produto não encontrado -> adicionar novo
-        if not encontrado:
-            tipo_mov = "Entrada" if str(acao).strip().upper() in ["COMPRA","ENTRADA"] else acao
-            ws.append_row([produto_norm, int(quantidade), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
-            mv = registrar_movimentacao(produto_norm, int(quantidade), tipo_mov, responsavel, observacao)
+
+            # Produto não encontrado -> adicionar novo
+            tipo_mov = tipo_produto_novo(acao)
+            linha = linha_movimentacao(produto_norm, int(quantidade), tipo_mov, responsavel, observacao)
+            backend_estoque.adicionar_produto(produto_norm, int(quantidade), linha)
+            mv = {"status":"sucesso","mensagem":"Movimentação registrada","linha":linha}
             return {"status":"sucesso","produto":produto_norm,"quantidade":int(quantidade),"novo_saldo":int(quantidade),"movimentacao":mv,"mensagem":f"Produto '{produto_norm}' novo adicionado ao estoque."}
     except Exception as e:
         return {"status":"erro","mensagem":str(e)}
 
 def registrar_evento_calendar(titulo: str, descricao: str, data: str, hora: str, duracao_minutos: int = 60) -> Dict[str, Any]:
     """ Agenda evento no Google Calendar. """
-    if not calendar_service:
-        return {"status": "erro", "mensagem": "Serviço de Calendário não inicializado."}
+    try:
+        servico = cliente_calendar()
+    except Exception as e:
+        return {"status": "erro", "mensagem": f"Serviço de Calendário não inicializado: {e}"}
     try:
         dt = datetime.datetime.strptime(f"{data} {hora}", "%Y-%m-%d %H:%M")
         inicio = dt.isoformat()
@@ -179,7 +1865,12 @@ def registrar_evento_calendar(titulo: str, descricao: str, data: str, hora: str,
             'start': {'dateTime': inicio, 'timeZone': 'America/Sao_Paulo'},
             'end': {'dateTime': fim, 'timeZone': 'America/Sao_Paulo'},
         }
-        ev = calendar_service.events().insert(calendarId=CALENDAR_ID, body=evento).execute()
+        ev = chamar_com_cota(
+            COTAS["calendar"],
+            lambda: servico.events().insert(calendarId=CALENDAR_ID, body=evento).execute(),
+            PRIORIDADE_ESCRITA,
+            idempotente=False,
+        )
         return {"status":"sucesso", "mensagem": f"Evento criado no calendário: {ev.get('summary','(sem título)')}", "link": ev.get('htmlLink','')}
     except Exception as e:
         return {"status":"erro","mensagem": str(e)}
@@ -194,8 +1885,6 @@ FUNCTION_MAP = {
     "registrar_movimentacao": registrar_movimentacao
 }
 
-genai.configure(api_key=GEMINI_API_KEY)
-
 SYSTEM_INSTRUCTION = (
     "Você é o 'ESTOQUE BOT', um assistente amigável para gerenciar estoque de bebidas. "
     "Compreende linguagem natural, pode registrar compras, vendas, consultar saldos, registrar movimentações "
@@ -203,103 +1892,775 @@ SYSTEM_INSTRUCTION = (
 )
 
 # Funções de Memória (para contexto persistente)
-conversas_usuarios = {}
 
-def caminho_memoria(user_id: int) -> str:
-    return os.path.join(MEMORY_FOLDER, f"memory_{user_id}.json")
+class MemoriaUsuarios:
+    """
+    Memória por usuário: LRU em processo para os usuários ativos e SQLite (WAL) como persistência.
+    salvar() só marca o registro como sujo; uma thread grava os sujos em uma única transação.
+    """
 
-def carregar_memoria(user_id: int):
-    path = caminho_memoria(user_id)
-    if os.path.exists(path):
+    def __init__(self, caminho_db: str, capacidade: int, intervalo_ms: int):
+        self.caminho_db = caminho_db
+        self.capacidade = capacidade
+        self.intervalo = intervalo_ms / 1000.0
+        self._lru: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._sujos: Dict[int, str] = {}   # user_id -> JSON pendente de gravação
+        self._lock = threading.Lock()
+        self._lock_db = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.acertos = 0
+        self.leituras_db = 0
+        self.gravacoes_db = 0
+
+    def _conexao(self) -> sqlite3.Connection:
+        with self._lock_db:
+            if self._conn is None:
+                os.makedirs(os.path.dirname(self.caminho_db) or ".", exist_ok=True)
+                conn = sqlite3.connect(self.caminho_db, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS memoria ("
+                    " user_id INTEGER PRIMARY KEY,"
+                    " dados TEXT NOT NULL,"
+                    " atualizado_em TEXT NOT NULL)"
+                )
+                self._conn = conn
+                self._migrar_json(conn)
+            return self._conn
+
+    def _migrar_json(self, conn: sqlite3.Connection):
+        """Importa os antigos memory_<user_id>.json da pasta do banco (uma vez; renomeia para .migrado)."""
+        pasta = os.path.dirname(self.caminho_db) or "."
+        arquivos = glob.glob(os.path.join(pasta, "memory_*.json"))
+        if not arquivos:
+            return
+        importados = 0
+        conn.execute("BEGIN")
+        try:
+            for path in arquivos:
+                try:
+                    user_id = int(os.path.basename(path)[len("memory_"):-len(".json")])
+                    with open(path, "r", encoding="utf-8") as f:
+                        dados = json.load(f)
+                except Exception:
+                    continue
+                # Não sobrescreve o que já estiver no banco (migração parcial anterior)
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO memoria (user_id, dados, atualizado_em) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(dados, ensure_ascii=False), agora_str()),
+                )
+                importados += cur.rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for path in arquivos:
+            try:
+                os.replace(path, path + ".migrado")
+            except OSError:
+                pass
+        log.info(f"📦 Memória: {importados} arquivos JSON importados para o SQLite.")
+
+    def _lembrar(self, user_id: int, mem: Dict[str, Any]):
+        """Coloca no LRU (chamar com self._lock). Usuários sujos não saem antes do flush."""
+        self._lru[user_id] = mem
+        self._lru.move_to_end(user_id)
+        while len(self._lru) > self.capacidade:
+            antigo = next(iter(self._lru))
+            if antigo in self._sujos:
+                self._acordar.set()
+                break
+            self._lru.popitem(last=False)
+
+    def carregar(self, user_id: int) -> Dict[str, Any]:
+        with self._lock:
+            mem = self._lru.get(user_id)
+            if mem is not None:
+                self._lru.move_to_end(user_id)
+                self.acertos += 1
+                return mem
+        conn = self._conexao()
+        with self._lock_db:
+            row = conn.execute("SELECT dados FROM memoria WHERE user_id = ?", (user_id,)).fetchone()
+        self.leituras_db += 1
+        try:
+            mem = json.loads(row[0]) if row else {}
+        except ValueError:
+            mem = {}
+        with self._lock:
+            # Outra thread pode ter salvo uma versão mais nova enquanto líamos o banco
+            mem = self._lru.get(user_id, mem)
+            self._lembrar(user_id, mem)
+        return mem
+
+    def salvar(self, user_id: int, mem: Dict[str, Any]):
+        # Serializa já aqui: o flush roda em outra thread e o dict continua sendo alterado pelo handler
+        dados = json.dumps(mem, ensure_ascii=False)
+        with self._lock:
+            self._sujos[user_id] = dados
+            self._lembrar(user_id, mem)
+        self._garantir_thread()
+
+    def flush(self):
+        with self._lock:
+            sujos, self._sujos = self._sujos, {}
+        if not sujos:
+            return
+        agora = agora_str()
+        linhas = [(uid, dados, agora) for uid, dados in sujos.items()]
+        conn = self._conexao()
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            with self._lock_db:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO memoria (user_id, dados, atualizado_em) VALUES (?, ?, ?)", linhas)
+                conn.execute("COMMIT")
+            self.gravacoes_db += len(linhas)
+        except Exception as e:
+            log.warning(f"❌ Falha ao gravar memória no SQLite (vai tentar de novo): {e}")
+            with self._lock_db:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            with self._lock:
+                for uid, dados in sujos.items():
+                    self._sujos.setdefault(uid, dados)
+
+    def _loop(self):
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            self.flush()
+
+    def _garantir_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="memoria-flush", daemon=True)
+                    self._thread.start()
+
+    def encerrar(self):
+        self._parar.set()
+        self._acordar.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock_db:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+memoria_usuarios = MemoriaUsuarios(MEMORY_DB, MEMORIA_LRU, MEMORIA_FLUSH_MS)
+
+def carregar_memoria(user_id: int):
+    return memoria_usuarios.carregar(user_id)
 
 def salvar_memoria(user_id: int, mem_obj):
-    path = caminho_memoria(user_id)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(mem_obj, f, ensure_ascii=False, indent=2)
+    memoria_usuarios.salvar(user_id, mem_obj)
 
-def criar_chat_para_usuario(user_id: int):
-    model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        system_instruction=SYSTEM_INSTRUCTION,
-        tools=[
-            genai.types.FunctionDeclaration(
-                name="atualizar_saldo",
-                description="Atualiza o estoque e registra movimentação. Args: produto, quantidade, acao, responsavel, observacao",
-                parameters={
-                    "type":"object",
-                    "properties":{
-                        "produto":{"type":"string"},
-                        "quantidade":{"type":"integer"},
-                        "acao":{"type":"string"},
-                        "responsavel":{"type":"string"},
-                        "observacao":{"type":"string"}
-                    },
-                    "required":["produto","quantidade","acao"]
-                }
-            ),
-            genai.types.FunctionDeclaration(
-                name="obter_saldo",
-                description="Consulta o saldo de um produto. Args: produto",
-                parameters={
-                    "type":"object",
-                    "properties":{"produto":{"type":"string"}},
-                    "required":["produto"]
-                }
-            ),
-            genai.types.FunctionDeclaration(
-                name="registrar_evento",
-                description="Agenda evento no calendário. Args: titulo, descricao, data (YYYY-MM-DD), hora (HH:MM), duracao_minutos (opcional)",
-                parameters={
-                    "type":"object",
-                    "properties":{
-                        "titulo":{"type":"string"},
-                        "descricao":{"type":"string"},
-                        "data":{"type":"string"},
-                        "hora":{"type":"string"},
-                        "duracao_minutos":{"type":"integer"}
-                    },
-                    "required":["titulo","data","hora"]
-                }
-            ),
-            genai.types.FunctionDeclaration(
-                name="registrar_movimentacao",
-                description="Registra movimentação manual. Args: produto, quantidade, tipo, responsavel, observacao",
-                parameters={
-                    "type":"object",
-                    "properties":{
-                        "produto":{"type":"string"},
-                        "quantidade":{"type":"integer"},
-                        "tipo":{"type":"string"},
-                        "responsavel":{"type":"string"},
-                        "observacao":{"type":"string"}
-                    },
-                    "required":["produto","quantidade","tipo"]
-                }
-            )
-        ]
+# Declarações das funções expostas ao Gemini (viram FunctionDeclaration em obter_modelo)
+FERRAMENTAS = [
+    dict(
+        name="atualizar_saldo",
+        description=("Atualiza o estoque e registra movimentação. Args: produto, quantidade, acao, responsavel, observacao, "
+                     "produto_novo (true só quando o usuário confirmar que é um produto novo, após status 'ambiguo')"),
+        parameters={
+            "type":"object",
+            "properties":{
+                "produto":{"type":"string"},
+                "quantidade":{"type":"integer"},
+                "acao":{"type":"string"},
+                "responsavel":{"type":"string"},
+                "observacao":{"type":"string"},
+                "produto_novo":{"type":"boolean"}
+            },
+            "required":["produto","quantidade","acao"]
+        }
+    ),
+    dict(
+        name="obter_saldo",
+        description="Consulta o saldo de um produto. Args: produto",
+        parameters={
+            "type":"object",
+            "properties":{"produto":{"type":"string"}},
+            "required":["produto"]
+        }
+    ),
+    dict(
+        name="registrar_evento",
+        description="Agenda evento no calendário. Args: titulo, descricao, data (YYYY-MM-DD), hora (HH:MM), duracao_minutos (opcional)",
+        parameters={
+            "type":"object",
+            "properties":{
+                "titulo":{"type":"string"},
+                "descricao":{"type":"string"},
+                "data":{"type":"string"},
+                "hora":{"type":"string"},
+                "duracao_minutos":{"type":"integer"}
+            },
+            "required":["titulo","data","hora"]
+        }
+    ),
+    dict(
+        name="registrar_movimentacao",
+        description="Registra movimentação manual. Args: produto, quantidade, tipo, responsavel, observacao",
+        parameters={
+            "type":"object",
+            "properties":{
+                "produto":{"type":"string"},
+                "quantidade":{"type":"integer"},
+                "tipo":{"type":"string"},
+                "responsavel":{"type":"string"},
+                "observacao":{"type":"string"}
+            },
+            "required":["produto","quantidade","tipo"]
+        }
     )
-    chat = model.start_chat(history=[])
-    mem = carregar_memoria(user_id)
-    if mem and isinstance(mem, dict):
-        summary = mem.get("summary")
-        if summary:
+]
+
+_modelo = None
+_lock_modelo = threading.Lock()
+
+def obter_modelo():
+    """GenerativeModel compartilhado por todas as sessões (o SDK é importado e configurado aqui)."""
+    global _modelo
+    with _lock_modelo:
+        if _modelo is None:
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            _modelo = genai.GenerativeModel(
+                model_name="gemini-2.5-flash",
+                system_instruction=SYSTEM_INSTRUCTION,
+                tools=[genai.types.FunctionDeclaration(**f) for f in FERRAMENTAS]
+            )
+        return _modelo
+
+# =========================
+# 🧠 Resumo da conversa e orçamento de tokens do histórico
+# =========================
+PREFIXO_MEMORIA = "[MEMÓRIA]"
+RESUMO_MAX_PRODUTOS = 8
+RESUMO_MAX_EVENTOS = 5
+RESUMO_MAX_ASSUNTOS = 5
+
+def estimar_tokens(conteudo) -> int:
+    """Estimativa local (~4 caracteres por token) de um Content do Gemini ou do dict equivalente."""
+    partes = conteudo.get("parts", []) if isinstance(conteudo, dict) else getattr(conteudo, "parts", [])
+    caracteres = 0
+    for parte in partes:
+        if isinstance(parte, str):
+            caracteres += len(parte)
+            continue
+        caracteres += len(getattr(parte, "text", "") or "")
+        chamada = getattr(parte, "function_call", None)
+        if chamada is not None and chamada.name:
+            caracteres += len(chamada.name) + len(str(dict(chamada.args or {})))
+        retorno = getattr(parte, "function_response", None)
+        if retorno is not None and retorno.name:
+            caracteres += len(retorno.name) + len(str(retorno.response))
+    return caracteres // 4 + 4   # + papel e separadores
+
+def _papel(conteudo) -> str:
+    return conteudo.get("role", "") if isinstance(conteudo, dict) else getattr(conteudo, "role", "")
+
+def _texto_conteudo(conteudo) -> str:
+    partes = conteudo.get("parts", []) if isinstance(conteudo, dict) else getattr(conteudo, "parts", [])
+    return " ".join(p if isinstance(p, str) else (getattr(p, "text", "") or "") for p in partes).strip()
+
+def registrar_no_resumo(mem: Dict[str, Any], chamadas: List[tuple], resultados: List[tuple]):
+    """Guarda na memória o que importa das funções do turno: produtos com o último saldo e eventos agendados."""
+    resumo = mem.setdefault("resumo", {})
+    produtos = resumo.get("produtos", [])
+    eventos = resumo.get("eventos", [])
+    for (fname, args), (_, r) in zip(chamadas, resultados):
+        if not isinstance(r, dict) or r.get("status") != "sucesso":
+            continue
+        if fname in ("atualizar_saldo", "obter_saldo") and r.get("produto"):
+            saldo = r.get("novo_saldo", r.get("quantidade"))
+            produtos = [p for p in produtos if p["produto"] != r["produto"]]
+            produtos.append({"produto": r["produto"], "saldo": saldo, "em": agora_str()[:16]})
+        elif fname == "registrar_evento":
+            eventos.append({"titulo": args.get("titulo", ""), "data": args.get("data", ""), "hora": args.get("hora", "")})
+    resumo["produtos"] = produtos[-RESUMO_MAX_PRODUTOS:]
+    resumo["eventos"] = eventos_pendentes(eventos)[-RESUMO_MAX_EVENTOS:]
+
+def eventos_pendentes(eventos: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    agora = agora_str()[:16]
+    return [e for e in eventos if f"{e.get('data', '')} {e.get('hora', '')}" >= agora]
+
+def texto_resumo(mem: Dict[str, Any]) -> str:
+    """Resumo estruturado em texto curto para abrir o histórico da sessão."""
+    resumo = mem.get("resumo") or {}
+    linhas = []
+    if resumo.get("produtos"):
+        linhas.append("Produtos recentes: " + "; ".join(
+            f"{p['produto']} (saldo {p['saldo']} em {p['em']})" for p in resumo["produtos"]))
+    pendentes = eventos_pendentes(resumo.get("eventos", []))
+    if pendentes:
+        linhas.append("Eventos agendados: " + "; ".join(f"{e['titulo']} em {e['data']} {e['hora']}" for e in pendentes))
+    if resumo.get("assuntos"):
+        linhas.append("Assuntos anteriores: " + " | ".join(resumo["assuntos"]))
+    if not linhas and mem.get("summary"):
+        linhas.append(mem["summary"])   # memória antiga, de antes do resumo estruturado
+    return "\n".join(linhas)
+
+def historico_inicial(mem) -> List[Dict[str, Any]]:
+    """Reconstrói o contexto da sessão a partir do resumo persistido, sem chamar o Gemini."""
+    if not mem or not isinstance(mem, dict):
+        return []
+    texto = texto_resumo(mem)
+    if not texto:
+        return []
+    return [
+        {"role": "user", "parts": [f"{PREFIXO_MEMORIA} {texto}"]},
+        {"role": "model", "parts": ["Entendido, vou considerar esse contexto."]},
+    ]
+
+def compactar_historico(chat, mem: Dict[str, Any], max_tokens: int = HISTORICO_MAX_TOKENS) -> int:
+    """
+    Mantém o histórico do chat dentro do orçamento de tokens. As trocas mais antigas saem
+    (menos as HISTORICO_TURNOS_MINIMOS últimas) e viram 'assuntos' no resumo da memória;
+    produtos e eventos já foram guardados por registrar_no_resumo. Retorna quantos itens saíram.
+    """
+    try:
+        historico = list(chat.history)
+    except Exception as e:
+        # Resposta anterior quebrada (ex.: bloqueada por segurança): deixa o histórico como está
+        log.warning(f"⚠️ Histórico do chat indisponível para compactar: {e}")
+        return 0
+    if len(historico) >= 2 and _texto_conteudo(historico[0]).startswith(PREFIXO_MEMORIA):
+        historico = historico[2:]   # o par de memória é refeito com o resumo atualizado
+    custos = [estimar_tokens(c) for c in historico]
+    orcamento = max_tokens - sum(estimar_tokens(c) for c in historico_inicial(mem))
+    if sum(custos) <= orcamento:
+        return 0
+    # Só corta no começo de uma troca (mensagem do usuário, não resultado de função)
+    inicios = [i for i, c in enumerate(historico)
+               if i > 0 and _papel(c) == "user" and not _texto_conteudo(c).startswith("Resultado")]
+    permitidos = inicios[:-HISTORICO_TURNOS_MINIMOS] if HISTORICO_TURNOS_MINIMOS else inicios
+    if not permitidos:
+        return 0
+    corte = next((i for i in permitidos if sum(custos[i:]) <= orcamento), permitidos[-1])
+
+    assuntos = mem.setdefault("resumo", {}).get("assuntos", [])
+    for c in historico[:corte]:
+        texto = _texto_conteudo(c)
+        if _papel(c) == "user" and texto and not texto.startswith(("Resultado", PREFIXO_MEMORIA)):
+            assuntos.append(texto[:100])
+    mem["resumo"]["assuntos"] = assuntos[-RESUMO_MAX_ASSUNTOS:]
+    chat.history = historico_inicial(mem) + historico[corte:]
+    metricas.contar("estoque_historico_compactacoes_total")
+    return corte
+
+def criar_chat_para_usuario(user_id: int):
+    return obter_modelo().start_chat(history=historico_inicial(carregar_memoria(user_id)))
+
+class PoolSessoes:
+    """
+    Chats Gemini por usuário com limite de sessões (LRU) e expiração por ociosidade.
+    Uma sessão descartada é recriada do resumo salvo na memória do usuário.
+    """
+
+    def __init__(self, max_sessoes: int, idle_s: int):
+        self.max_sessoes = max_sessoes
+        self.idle_s = idle_s
+        self._sessoes: "OrderedDict[int, List[Any]]" = OrderedDict()  # user_id -> [chat, último uso]
+        self._lock = threading.Lock()
+        self.criadas = 0
+        self.reutilizadas = 0
+        self.descartadas = 0
+
+    def _expurgar(self, agora: float):
+        while self._sessoes:
+            user_id, (_, ultimo_uso) = next(iter(self._sessoes.items()))
+            if len(self._sessoes) <= self.max_sessoes and agora - ultimo_uso <= self.idle_s:
+                break
+            self._sessoes.popitem(last=False)
+            self.descartadas += 1
+
+    def obter(self, user_id: int):
+        agora = time.monotonic()
+        with self._lock:
+            self._expurgar(agora)
+            sessao = self._sessoes.get(user_id)
+            if sessao is not None:
+                sessao[1] = agora
+                self._sessoes.move_to_end(user_id)
+                self.reutilizadas += 1
+                return sessao[0]
+        chat = criar_chat_para_usuario(user_id)
+        with self._lock:
+            self._sessoes[user_id] = [chat, agora]
+            self._sessoes.move_to_end(user_id)
+            self.criadas += 1
+            self._expurgar(agora)
+        return chat
+
+    def descartar(self, user_id: int):
+        with self._lock:
+            if self._sessoes.pop(user_id, None) is not None:
+                self.descartadas += 1
+
+    def __len__(self) -> int:
+        return len(self._sessoes)
+
+pool_sessoes = PoolSessoes(MAX_SESSOES, SESSAO_IDLE_S)
+
+def obter_chat_usuario(user_id: int):
+    return pool_sessoes.obter(user_id)
+
+# =========================
+# ⚙️ Execução fora do event loop (pools por backend)
+# =========================
+EXECUTORES = {
+    "llm": ThreadPoolExecutor(max_workers=POOL_LLM_WORKERS, thread_name_prefix="llm"),
+    "sheets": ThreadPoolExecutor(max_workers=POOL_SHEETS_WORKERS, thread_name_prefix="sheets"),
+    "calendar": ThreadPoolExecutor(max_workers=POOL_CALENDAR_WORKERS, thread_name_prefix="calendar"),
+    "memoria": ThreadPoolExecutor(max_workers=POOL_MEMORIA_WORKERS, thread_name_prefix="memoria"),
+}
+
+# Backend usado por cada função do FUNCTION_MAP
+BACKEND_FUNCAO = {
+    "atualizar_saldo": "sheets",
+    "obter_saldo": "sheets",
+    "registrar_movimentacao": "sheets",
+    "registrar_evento": "calendar",
+}
+
+async def em_thread(backend: str, fn, *args, **kwargs):
+    """Roda uma função síncrona no pool do backend sem bloquear o event loop."""
+    loop = asyncio.get_running_loop()
+    enfileirado = time.perf_counter()
+    # copy_context: o trace da mensagem continua visível dentro da thread
+    ctx = contextvars.copy_context()
+
+    def rodar():
+        metricas.observar("estoque_pool_espera_segundos", time.perf_counter() - enfileirado, backend=backend)
+        return ctx.run(fn, *args, **kwargs)
+
+    return await loop.run_in_executor(EXECUTORES[backend], rodar)
+
+# Um lock por usuário: mensagens do mesmo usuário em ordem, usuários diferentes em paralelo
+_locks_usuarios: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def lock_usuario(user_id: int) -> asyncio.Lock:
+    lock = _locks_usuarios.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks_usuarios[user_id] = lock
+    return lock
+
+def encerrar_executores():
+    for executor in EXECUTORES.values():
+        executor.shutdown(wait=True)
+
+# =========================
+# ⚡ Atalho determinístico (sem Gemini) para comandos comuns
+# =========================
+_RE_SALDO = re.compile(
+    r"^(?:qual\s+(?:[ée]\s+)?(?:o\s+)?)?(?:saldo|estoque)\s+(?:de|do|da|dos|das)\s+(?P<produto>.+?)\s*\??$",
+    re.IGNORECASE,
+)
+_RE_QUANTO = re.compile(
+    r"^quant[oa]s?\s+(?:tem|temos|h[aá]|tenho)\s+(?:de|do|da|dos|das)\s+(?P<produto>.+?)(?:\s+(?:no|em)\s+estoque)?\s*\??$",
+    re.IGNORECASE,
+)
+_RE_QUANTAS = re.compile(
+    r"^quant[oa]s\s+(?P<produto>.+?)\s+(?:tem|temos|h[aá]|restam|sobraram)(?:\s+(?:no|em)\s+estoque)?\s*\??$",
+    re.IGNORECASE,
+)
+_RE_MOVIMENTO = re.compile(
+    r"^(?P<verbo>vendi|vendemos|comprei|compramos|chegou|chegaram|entrou|entraram|saiu|sa[ií]ram)\s+"
+    r"(?P<qtd>\d+)\s+(?:(?:unidades?|un\.?)\s+)?(?:de\s+)?(?P<produto>.+?)\s*[.!]?$",
+    re.IGNORECASE,
+)
+ACAO_POR_VERBO = {
+    "vendi": "VENDA", "vendemos": "VENDA", "saiu": "VENDA", "sairam": "VENDA", "saíram": "VENDA",
+    "comprei": "COMPRA", "compramos": "COMPRA", "chegou": "COMPRA", "chegaram": "COMPRA",
+    "entrou": "COMPRA", "entraram": "COMPRA",
+}
+# Embalagens mudam a quantidade real (caixa de 12, fardo de 6...): nesses casos quem decide é o Gemini
+_RE_EMBALAGEM = re.compile(r"^(?:caixas?|cx|fardos?|engradados?|pacotes?|packs?|garrafas?|latas?|litros?)\b", re.IGNORECASE)
+# Mais de um produto na mesma frase ("2 Skol e 5 Brahma", "Heineken e Coca-Cola", "Skol mais gelo")
+# também vai para o Gemini
+_RE_VARIOS = re.compile(r"(?:,|;|\s+e\s+|\bmais\b)", re.IGNORECASE)
+
+ESTATISTICAS_ATALHO = {"mensagens": 0, "acertos": 0, "desvios_llm": 0, "latencia_total_ms": 0.0}
+
+def interpretar_comando(texto: str) -> Optional[tuple]:
+    """Reconhece consulta de saldo e compra/venda com quantidade. Retorna (função, args) ou None se ambíguo."""
+    texto = " ".join(texto.strip().split())
+    if not texto:
+        return None
+    m = _RE_SALDO.match(texto) or _RE_QUANTO.match(texto) or _RE_QUANTAS.match(texto)
+    if m:
+        produto = m.group("produto").strip(" ?.!")
+        if produto and not _RE_VARIOS.search(produto):
+            return ("obter_saldo", {"produto": produto})
+        return None
+    m = _RE_MOVIMENTO.match(texto)
+    if m:
+        produto = m.group("produto").strip(" ?.!")
+        if not produto or _RE_EMBALAGEM.match(produto) or _RE_VARIOS.search(produto):
+            return None
+        acao = ACAO_POR_VERBO.get(m.group("verbo").lower())
+        if acao and int(m.group("qtd")) > 0:
+            return ("atualizar_saldo", {"produto": produto, "quantidade": int(m.group("qtd")), "acao": acao})
+    return None
+
+def executar_atalho(fname: str, args: Dict[str, Any], responsavel: str) -> Optional[tuple]:
+    """
+    Executa o comando reconhecido e devolve (resposta pronta, resultado da função);
+    None manda a mensagem para o Gemini.
+    """
+    if fname == "atualizar_saldo":
+        # Só grava com nome exato ou termos cobertos; parecido ("vendi 3 Heineken ontem"),
+        # ambíguo ou desconhecido (erro de digitação ou cadastro novo) o Gemini trata melhor
+        res = backend_estoque.resolver(args["produto"], escrita=True)
+        if res["ambiguo"] or not res["item"]:
+            return None
+    else:
+        res = backend_estoque.resolver(args["produto"])
+        if res["ambiguo"]:
+            mensagem = mensagem_ambiguidade(args["produto"], res["candidatos"])
+            return "🤔 " + mensagem, {"status":"ambiguo","mensagem":mensagem,"candidatos":res["candidatos"]}
+        if not res["item"]:
+            return None
+    if fname == "obter_saldo":
+        r = obter_saldo(args["produto"])
+        if r.get("status") != "sucesso":
+            return None
+        return f"📦 {r['produto']}: {r['quantidade']} em estoque.", r
+    r = atualizar_saldo(args["produto"], args["quantidade"], args["acao"], responsavel=responsavel)
+    if r.get("status") != "sucesso":
+        return f"⚠️ Não consegui registrar: {r.get('mensagem', 'erro desconhecido')}", r
+    verbo = "Venda" if args["acao"] == "VENDA" else "Entrada"
+    return f"✅ {verbo} registrada: {r['quantidade']} × {r['produto']}. Novo saldo: {r['novo_saldo']}.", r
+
+async def tentar_atalho(user_text: str, user_name: str) -> Optional[tuple]:
+    """Devolve (resposta, (fname, args), resultado) quando o atalho resolve; None segue para o Gemini."""
+    if not ATALHO_ATIVO:
+        return None
+    inicio = time.perf_counter()
+    ESTATISTICAS_ATALHO["mensagens"] += 1
+    comando = interpretar_comando(user_text)
+    atalho = None
+    if comando:
+        fname, args = comando
+        atalho = await em_thread("sheets", executar_atalho, fname, args, user_name)
+    if atalho is None:
+        ESTATISTICAS_ATALHO["desvios_llm"] += 1
+        return None
+    ESTATISTICAS_ATALHO["acertos"] += 1
+    ESTATISTICAS_ATALHO["latencia_total_ms"] += (time.perf_counter() - inicio) * 1000
+    resposta, resultado = atalho
+    return resposta, comando, resultado
+
+# =========================
+# 🚚 Lançamento em lote (/lote)
+# =========================
+# Ações aceitas numa linha do lote (sem acento e em maiúsculas); sem ação, vale COMPRA
+ACOES_LOTE = {"COMPRA","ENTRADA","IN","+","VENDA","SAIDA","OUT","-","AJUSTE"}
+_RE_MARCADOR_LISTA = re.compile(r"^(?:[-•*]|\d+[.)])\s+")
+_RE_INTEIRO = re.compile(r"^\d+$")
+LIMITE_MENSAGEM_TELEGRAM = 4000
+
+def dividir_campos(linha: str) -> Optional[List[str]]:
+    """Separa 'produto;quantidade;acao' (aceita ';', tab ou ','). None se a linha não tem separador."""
+    for sep in (";", "\t", ","):
+        if sep in linha:
+            return [c.strip() for c in linha.split(sep)]
+    return None
+
+def interpretar_lote(texto: str) -> tuple:
+    """
+    Lê uma linha por movimentação: 'Skol Lata;24;compra', 'Skol Lata,24' ou 'vendi 3 Skol Lata'.
+    Devolve (pedidos, invalidas): pedidos = [(nº da linha, produto, quantidade, acao)]
+    e invalidas = [(nº da linha, texto, motivo)]. Um cabeçalho de CSV na primeira linha é ignorado.
+    """
+    pedidos: List[tuple] = []
+    invalidas: List[tuple] = []
+    primeira = True
+    for n, bruta in enumerate(texto.splitlines(), start=1):
+        linha = _RE_MARCADOR_LISTA.sub("", bruta.strip())
+        if not linha:
+            continue
+        eh_primeira, primeira = primeira, False
+        campos = dividir_campos(linha)
+        if campos is None:
+            comando = interpretar_comando(linha)
+            if comando and comando[0] == "atualizar_saldo":
+                args = comando[1]
+                pedidos.append((n, args["produto"], args["quantidade"], args["acao"]))
+            else:
+                invalidas.append((n, linha, "use produto;quantidade;ação"))
+            continue
+        campos = [c for c in campos if c] + [""] * 3
+        produto, qtd, acao = campos[:3]
+        # Aceita também 'quantidade;produto;ação'
+        if _RE_INTEIRO.match(produto) and not _RE_INTEIRO.match(qtd):
+            produto, qtd = qtd, produto
+        if not _RE_INTEIRO.match(qtd):
+            if not eh_primeira:
+                invalidas.append((n, linha, "quantidade inválida"))
+            continue
+        acao = acao if acao in ("+", "-") else (dobrar_texto(acao).upper() or "COMPRA")
+        acao = ACAO_POR_VERBO.get(acao.lower(), acao)
+        if not produto:
+            invalidas.append((n, linha, "produto vazio"))
+        elif int(qtd) <= 0:
+            invalidas.append((n, linha, "quantidade deve ser maior que zero"))
+        elif acao not in ACOES_LOTE:
+            invalidas.append((n, linha, f"ação '{campos[2]}' desconhecida"))
+        else:
+            pedidos.append((n, produto, int(qtd), acao))
+    return pedidos, invalidas
+
+def registrar_lote(texto: str, responsavel: str="") -> Dict[str, Any]:
+    """Aplica todas as linhas válidas do lote de uma vez e devolve o resultado de cada linha."""
+    try:
+        pedidos, invalidas = interpretar_lote(texto)
+        if not pedidos:
+            return {"status":"vazio","mensagem":"Nenhuma linha válida no lote.","invalidas":invalidas}
+        itens = []
+        for _, produto, qtd, acao in pedidos:
+            delta, tipo = classificar_acao(acao, qtd)
+            itens.append({"produto": produto, "quantidade": qtd, "delta": delta, "tipo": tipo, "tipo_novo": tipo_produto_novo(acao),
+                          "responsavel": responsavel, "observacao": "Lote"})
+        # Mesmas faixas de lock do atualizar_saldo: o nome digitado (produto novo) e o produto resolvido
+        nomes = [i["produto"] for i in itens]
+        for i in itens:
+            item = backend_estoque.buscar(i["produto"])
+            if item:
+                nomes.append(item["produto"])
+        with locks_produto.travar_varios(nomes):
+            resultados = backend_estoque.aplicar_lote(itens)
+        linhas = [{"linha": n, "pedido": produto, "quantidade": qtd, "acao": acao, **r} for (n, produto, qtd, acao), r in zip(pedidos, resultados)]
+        return {"status":"sucesso","linhas":linhas,"invalidas":invalidas}
+    except Exception as e:
+        return {"status":"erro","mensagem":str(e)}
+
+def resumo_lote(resultado: Dict[str, Any]) -> str:
+    """Texto de resposta do /lote: uma linha por item do lote, na ordem em que foram enviados."""
+    if resultado["status"] == "erro":
+        return f"⚠️ Não consegui aplicar o lote: {resultado['mensagem']}"
+    saida = []
+    for r in resultado.get("linhas", []):
+        sinal = "-" if classificar_acao(r["acao"], r["quantidade"])[0] < 0 else "+"
+        if r["status"] == "ambiguo":
+            saida.append((r["linha"], f"🤔 {r['linha']}. {r['pedido']}: qual deles? {', '.join(r['candidatos'])} (não aplicado)"))
+        elif r["novo"]:
+            saida.append((r["linha"], f"🆕 {r['linha']}. {r['produto']}: cadastrado com {r['novo_saldo']}"))
+        else:
+            saida.append((r["linha"], f"✅ {r['linha']}. {r['produto']}: {sinal}{r['quantidade']} → saldo {r['novo_saldo']}"))
+    for n, linha, motivo in resultado.get("invalidas", []):
+        saida.append((n, f"⚠️ {n}. '{linha}': {motivo} (não aplicado)"))
+    if not saida:
+        return f"⚠️ {resultado.get('mensagem', 'Nenhuma linha válida no lote.')}"
+    aplicadas = sum(1 for r in resultado.get("linhas", []) if r["status"] == "sucesso")
+    cabecalho = f"🚚 Lote: {aplicadas} de {len(saida)} linhas aplicadas."
+    return "\n".join([cabecalho] + [texto for _, texto in sorted(saida)])
+
+def dividir_mensagem(texto: str, limite: int = LIMITE_MENSAGEM_TELEGRAM) -> List[str]:
+    """Quebra respostas longas em partes que cabem numa mensagem do Telegram (sem cortar linhas)."""
+    partes, atual = [], ""
+    for linha in texto.split("\n"):
+        if atual and len(atual) + len(linha) + 1 > limite:
+            partes.append(atual)
+            atual = ""
+        atual = f"{atual}\n{linha}" if atual else linha[:limite]
+    if atual:
+        partes.append(atual)
+    return partes
+
+# =========================
+# 🧰 Despacho das funções pedidas pelo Gemini
+# =========================
+def preparar_argumentos(fname: str, args: Dict[str, Any], user_name: str) -> Dict[str, Any]:
+    safe_args = {}
+    for k,v in args.items():
+        if k.lower() in ["quantidade","duracao_minutos","quantity","amount"]:
             try:
-                chat.send_message(f"[MEMÓRIA] {summary}")
+                # Garante que é int após a conversão para float, se for o caso
+                safe_args[k] = int(float(v))
             except:
-                pass
-    conversas_usuarios[user_id] = chat
-    return chat
+                safe_args[k] = v
+        else:
+            safe_args[k] = v
+    # Adiciona o nome do usuário se o campo for esperado pela função
+    if 'responsavel' in FUNCTION_MAP[fname].__annotations__ and 'responsavel' not in safe_args:
+        safe_args['responsavel'] = user_name
+    return safe_args
 
-def obter_chat_usuario(user_id: int):
-    if user_id in conversas_usuarios:
-        return conversas_usuarios[user_id]
-    return criar_chat_para_usuario(user_id)
+async def executar_funcao(fname: str, args: Dict[str, Any], user_name: str) -> Any:
+    if fname not in FUNCTION_MAP:
+        return {"status":"erro","mensagem":f"Função '{fname}' não está implementada no bot."}
+    try:
+        safe_args = preparar_argumentos(fname, args, user_name)
+        # Execução da função de negócio (Sheets/Calendar) no pool do backend
+        with medir("funcao", funcao=fname):
+            result = await em_thread(BACKEND_FUNCAO.get(fname, "sheets"), FUNCTION_MAP[fname], **safe_args)
+    except TypeError as te:
+        result = {"status":"erro","mensagem":f"Erro ao executar função: {te}"}
+    except Exception as e:
+        result = {"status":"erro","mensagem":f"Erro desconhecido na função: {e}"}
+    log.info(f"📊 Resultado da função {fname}: {result}")
+    return result
+
+def chave_de_grupo(produto: str) -> str:
+    """Nome normalizado do produto resolvido; o nome digitado quando não há produto parecido."""
+    try:
+        item = backend_estoque.buscar(str(produto))
+    except Exception:
+        item = None
+    return normalizar_nome(item["produto"] if item else produto)
+
+async def despachar_chamadas(chamadas: List[tuple], user_name: str) -> List[tuple]:
+    """
+    Executa as chamadas de um turno em paralelo. Chamadas sobre o mesmo produto ficam
+    no mesmo grupo e rodam em ordem; a lista devolvida segue a ordem pedida pelo Gemini.
+    """
+    # Agrupa pelo produto resolvido: "Skol" e "skol lata 350ml" mexem na mesma linha
+    produtos = [args.get("produto") for _, args in chamadas]
+    resolvidos = await em_thread("sheets", lambda: [chave_de_grupo(p) if p else None for p in produtos])
+    grupos: "OrderedDict[str, List[int]]" = OrderedDict()
+    for i, chave_produto in enumerate(resolvidos):
+        chave = f"produto:{chave_produto}" if chave_produto else f"chamada:{i}"
+        grupos.setdefault(chave, []).append(i)
+
+    resultados: List[Any] = [None] * len(chamadas)
+
+    async def rodar_grupo(indices: List[int]):
+        for i in indices:
+            fname, args = chamadas[i]
+            resultados[i] = await executar_funcao(fname, args, user_name)
+
+    await asyncio.gather(*(rodar_grupo(indices) for indices in grupos.values()))
+    return [(chamadas[i][0], resultados[i]) for i in range(len(chamadas))]
+
+# Campos dos resultados que o Gemini usa para responder (linha da planilha, movimentação etc. ficam de fora)
+CAMPOS_PARA_O_MODELO = ("status", "produto", "quantidade", "novo_saldo", "mensagem", "candidatos", "link")
+
+def resultado_para_o_modelo(result: Any) -> str:
+    """Resultado enxuto em JSON compacto (bem menos tokens que o str() do dict inteiro)."""
+    if not isinstance(result, dict):
+        return str(result)
+    enxuto = {k: result[k] for k in CAMPOS_PARA_O_MODELO if result.get(k) not in (None, "", [])}
+    if enxuto.get("status") == "sucesso" and enxuto.get("mensagem") == "Movimentação registrada":
+        del enxuto["mensagem"]
+    return json.dumps(enxuto, ensure_ascii=False, separators=(",", ":"))
+
+def mensagem_resultados(resultados: List[tuple]) -> str:
+    """Monta a mensagem de retorno ao Gemini com o resultado de todas as funções do turno."""
+    if len(resultados) == 1:
+        fname, result = resultados[0]
+        return f"Resultado da função {fname}: {resultado_para_o_modelo(result)}"
+    linhas = [f"Resultados das {len(resultados)} funções (na ordem pedida):"]
+    linhas += [f"{i}. {fname}: {resultado_para_o_modelo(result)}" for i, (fname, result) in enumerate(resultados, start=1)]
+    return "\n".join(linhas)
 
 # =========================================================================
 # Handler Telegram (Lógica Function Calling)
@@ -307,89 +2668,114 @@ def obter_chat_usuario(user_id: int):
 
 # Handler que processa todas as mensagens de texto
 async def responder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    trace: Dict[str, float] = {}
+    token = _trace_atual.set(trace)
+    inicio = time.perf_counter()
+    caminho = "erro"
+    try:
+        with medir("fila_usuario"):
+            lock = lock_usuario(update.effective_user.id)
+            await lock.acquire()
+        try:
+            caminho = await processar_mensagem(update, context)
+        finally:
+            lock.release()
+    finally:
+        total = time.perf_counter() - inicio
+        _trace_atual.reset(token)
+        metricas.observar("estoque_mensagem_segundos", total, caminho=caminho)
+        metricas.contar("estoque_mensagens_total", caminho=caminho)
+        # Uma linha JSON por mensagem com o tempo de cada etapa
+        log.info(json.dumps({
+            "evento": "mensagem",
+            "user_id": update.effective_user.id,
+            "caminho": caminho,
+            "total_ms": round(total * 1000, 2),
+            "etapas_ms": trace,
+        }, ensure_ascii=False))
+
+async def processar_mensagem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Processa a mensagem e devolve o caminho usado: 'atalho', 'llm' ou 'erro'."""
     user_text = update.message.text or ""
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name or ""
-    print(f"\n🗣️ [{user_name} | {user_id}] {user_text}")
+    log.info(f"🗣️ [{user_name} | {user_id}] {user_text}")
 
     # Atualiza memória simples
-    mem = carregar_memoria(user_id) or {}
+    with medir("memoria_carregar"):
+        mem = await em_thread("memoria", carregar_memoria, user_id) or {}
     recent = mem.get("recent_messages", [])
     recent.append({"at": datetime.datetime.now().isoformat(), "text": user_text})
     mem["recent_messages"] = recent[-50:]
-    mem["summary"] = f"Última: {recent[-1]['text']}" if recent else ""
     salvar_memoria(user_id, mem)
 
-    chat = obter_chat_usuario(user_id)
-
     try:
-        response = chat.send_message(user_text)
+        # Comandos simples ("saldo de X", "vendi 3 X") não passam pelo Gemini
+        with medir("atalho"):
+            atalho = await tentar_atalho(user_text, user_name)
+        if atalho:
+            resposta_atalho, comando, resultado = atalho
+            mem["last_reply"] = resposta_atalho
+            # O Gemini não viu este turno: o saldo entra no resumo para a próxima sessão
+            registrar_no_resumo(mem, [comando], [(comando[0], resultado)])
+            salvar_memoria(user_id, mem)
+            with medir("telegram_resposta"):
+                await update.message.reply_text(resposta_atalho)
+            log.info("⚡ Resposta enviada pelo atalho (sem Gemini).")
+            return "atalho"
+
+        with medir("sessao"):
+            chat = await em_thread("llm", obter_chat_usuario, user_id)
+        with medir("llm"):
+            response = await em_thread("llm", chat.send_message, user_text)
         final_reply = None
 
+        chamadas = []
+        resultados: List[tuple] = []
         if response.candidates and response.candidates[0].content and getattr(response.candidates[0].content, "parts", None):
             parts = response.candidates[0].content.parts
             for part in parts:
                 if getattr(part, "function_call", None):
                     fc = part.function_call
-                    fname = fc.name
                     args = dict(fc.args) if fc.args else {}
-                    print(f"⚙️ Gemini solicitou função: {fname} | args: {args}")
-
-                    if fname in FUNCTION_MAP:
-                        safe_args = {}
-                        for k,v in args.items():
-                            if k.lower() in ["quantidade","duracao_minutos","quantity","amount"]:
-                                try:
-                                    # Garante que é int após a conversão para float, se for o caso
-                                    safe_args[k] = int(float(v))
-                                except:
-                                    safe_args[k] = v
-                            else:
-                                safe_args[k] = v
-                        try:
-                            # Adiciona o nome do usuário se o campo for esperado pela função
-                            if 'responsavel' in FUNCTION_MAP[fname].__annotations__ and 'responsavel' not in safe_args:
-                                safe_args['responsavel'] = user_name
-
-                            # Execução da função de negócio (Sheets/Calendar)
-                            # Não precisa de await porque as funções de Sheets/Calendar não são assíncronas
-                            result = FUNCTION_MAP[fname](**safe_args)
-                        except TypeError as te:
-                            result = {"status":"erro","mensagem":f"Erro ao executar função: {te}"}
-                        except Exception as e:
-                            result = {"status":"erro","mensagem":f"Erro desconhecido na função: {e}"}
-                        
-                        print("📊 Resultado da função:", result)
-                        
-                        # Manda o resultado da função de volta para o Gemini para gerar a resposta em linguagem natural
-                        followup_msg = f"Resultado da função {fname}: {result}"
-                        followup = chat.send_message(followup_msg)
-                        
-                        # Extrai o texto da resposta final do Gemini
-                        text_candidate = getattr(followup, "text", None)
-                        if not text_candidate:
-                             try:
-                                 if followup.candidates and followup.candidates[0].content and getattr(followup.candidates[0].content, "parts", None):
-                                     for p2 in followup.candidates[0].content.parts:
-                                         if getattr(p2, "text", None):
-                                             text_candidate = p2.text
-                                             break
-                             except Exception:
-                                 pass
-                                 
-                        if text_candidate:
-                            final_reply = text_candidate
-                        else:
-                            # Fallback caso Gemini não gere texto de resposta
-                            if isinstance(result, dict):
-                                final_reply = result.get("mensagem") or result.get("message") or str(result)
-                            else:
-                                final_reply = str(result)
-                    else:
-                        final_reply = f"⚠️ O sistema tentou usar a função '{fname}', mas ela não está implementada no bot."
-                else:
-                    if getattr(part, "text", None):
-                        final_reply = part.text
+                    log.info(f"⚙️ Gemini solicitou função: {fc.name} | args: {args}")
+                    chamadas.append((fc.name, args))
+                elif getattr(part, "text", None):
+                    final_reply = part.text
+
+        implementadas = [c for c in chamadas if c[0] in FUNCTION_MAP]
+        if chamadas and not implementadas:
+            final_reply = f"⚠️ O sistema tentou usar a função '{chamadas[0][0]}', mas ela não está implementada no bot."
+        elif implementadas:
+            # Todas as funções do turno rodam juntas e voltam ao Gemini numa única mensagem
+            resultados = await despachar_chamadas(chamadas, user_name)
+            with medir("llm_followup"):
+                followup = await em_thread("llm", chat.send_message, mensagem_resultados(resultados))
+
+            # Extrai o texto da resposta final do Gemini
+            text_candidate = None
+            try:
+                text_candidate = getattr(followup, "text", None)
+            except Exception:
+                pass
+            if not text_candidate:
+                 try:
+                     if followup.candidates and followup.candidates[0].content and getattr(followup.candidates[0].content, "parts", None):
+                         for p2 in followup.candidates[0].content.parts:
+                             if getattr(p2, "text", None):
+                                 text_candidate = p2.text
+                                 break
+                 except Exception:
+                     pass
+
+            if text_candidate:
+                final_reply = text_candidate
+            else:
+                # Fallback caso Gemini não gere texto de resposta
+                final_reply = "\n".join(
+                    (r.get("mensagem") or r.get("message") or str(r)) if isinstance(r, dict) else str(r)
+                    for _, r in resultados
+                )
 
         if not final_reply:
             try:
@@ -398,61 +2784,269 @@ async def responder(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 final_reply = "Desculpa, não consegui processar sua solicitação. Tenta reformular?"
 
         # Salva o estado da memória
-        mem = carregar_memoria(user_id) or {}
+        with medir("memoria_carregar"):
+            mem = await em_thread("memoria", carregar_memoria, user_id) or {}
         mem["last_reply"] = final_reply
-        mem["summary"] = f"Última interação: {final_reply[:200]}"
+        registrar_no_resumo(mem, chamadas, resultados)
+        # Histórico acima do orçamento: trocas antigas saem e ficam só no resumo
+        with medir("historico"):
+            await em_thread("llm", compactar_historico, chat, mem)
         salvar_memoria(user_id, mem)
 
         # Envia a resposta final (usando await)
-        await update.message.reply_text(final_reply)
-        print("✅ Resposta enviada.")
-        
+        with medir("telegram_resposta"):
+            await update.message.reply_text(final_reply)
+        log.info("✅ Resposta enviada.")
+        return "llm"
+
     except Exception as e:
         tb = traceback.format_exc()
-        print("❌ Erro no handler:", e, tb)
+        log.error(f"❌ Erro no handler: {e}\n{tb}")
         await update.message.reply_text("⚠️ Ocorreu um erro interno. Veja logs no console.")
+        return "erro"
 
 # Handler de comando /start
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Envia uma mensagem de boas-vindas."""
     await update.message.reply_text(
         'Olá! Eu sou o ESTOQUE BOT. Posso ajudar a gerenciar seu inventário e agendar eventos. '
-        'Tente: "Comprei 10 caixas de Cerveja X" ou "Qual o saldo de Vodka?".'
+        'Tente: "Comprei 10 caixas de Cerveja X" ou "Qual o saldo de Vodka?".\n'
+        'Para várias entradas de uma vez, use /lote com uma linha por produto: produto;quantidade;ação '
+        '(ex.: "Skol Lata;24;compra").'
     )
 
+# Handler de comando /lote
+async def lote_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Aplica várias movimentações de uma vez (uma por linha), sem passar pelo Gemini."""
+    texto = re.sub(r"^/\w+(?:@\w+)?", "", update.message.text or "", count=1)
+    if not texto.strip():
+        await update.message.reply_text(
+            "Envie /lote seguido de uma linha por produto (ou cole um CSV):\n"
+            "Skol Lata;24;compra\nBrahma 600ml;12;compra\nVodka;2;venda\n"
+            "Ações: compra, entrada, venda, saída, ajuste (sem ação = compra)."
+        )
+        return
+    user_name = update.effective_user.first_name or ""
+    with medir("lote"):
+        resultado = await em_thread("sheets", registrar_lote, texto, user_name)
+    log.info(f"🚚 [{user_name} | {update.effective_user.id}] lote: {len(resultado.get('linhas', []))} linhas, "
+             f"{len(resultado.get('invalidas', []))} inválidas")
+    for parte in dividir_mensagem(resumo_lote(resultado)):
+        await update.message.reply_text(parte)
+
+# Handler de comando /recarregar
+async def recarregar_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Força a releitura da aba Estoque (ex.: após edição manual na planilha)."""
+    try:
+        # Baixa a aba inteira (e no SQLite sincroniza antes): fora do event loop
+        total = await em_thread("sheets", backend_estoque.recarregar)
+        await update.message.reply_text(f"🔄 Estoque recarregado: {total} produtos.")
+    except Exception as e:
+        await update.message.reply_text(f"⚠️ Não foi possível recarregar o estoque: {e}")
+
+# Handler de comando /status
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mostra contadores internos (cache de estoque e handles da planilha)."""
+    plan = registro_planilha.estatisticas()
+    linhas = [
+        "📈 Status do bot",
+        f"Estoque ({backend_estoque.nome}): " + " | ".join(f"{k}: {v}" for k, v in backend_estoque.estatisticas().items()),
+        f"Memória: acertos LRU: {memoria_usuarios.acertos} | leituras SQLite: {memoria_usuarios.leituras_db} | gravações: {memoria_usuarios.gravacoes_db}",
+        "Atalho sem Gemini: {acertos}/{mensagens} mensagens ({taxa:.0f}%) | latência média: {lat:.1f} ms".format(
+            acertos=ESTATISTICAS_ATALHO["acertos"], mensagens=ESTATISTICAS_ATALHO["mensagens"],
+            taxa=100.0 * ESTATISTICAS_ATALHO["acertos"] / max(ESTATISTICAS_ATALHO["mensagens"], 1),
+            lat=ESTATISTICAS_ATALHO["latencia_total_ms"] / max(ESTATISTICAS_ATALHO["acertos"], 1)),
+        f"Locks por produto: {LOCKS_PRODUTO_FAIXAS} faixas | esperas: {locks_produto.esperas}",
+        f"Sessões Gemini: ativas: {len(pool_sessoes)} | criadas: {pool_sessoes.criadas} | descartadas: {pool_sessoes.descartadas}",
+        f"Planilha: metadados buscados: {plan['chamadas_metadados']} | evitados: {plan['chamadas_evitadas']} | reconexões: {plan['reconexoes']}",
+        "Cotas Google: " + " | ".join(
+            f"{nome}: fila {e['fila']}, limitadas {e['limitadas']}/{e['chamadas']}, espera {e['espera_s']}s, retentativas {e['retentativas']}"
+            for nome, e in ((nome, cota.estatisticas()) for nome, cota in COTAS.items())
+        ) + f" | leituras unidas: {leituras_em_voo.unidas}",
+    ]
+    await update.message.reply_text("\n".join(linhas))
+
 
 # =========================
-# 🚀 Inicialização do Worker (Polling)
+# 🚀 Inicialização (Polling ou Webhook)
 # =========================
 
-async def main_async():
-    """Função principal assíncrona para configurar e iniciar o bot."""
-    
-    # 1. Configuração do Bot
-    app = Application.builder().token(TOKEN_TELEGRAM).build()
-    
-    # 2. Adiciona Handlers
+def montar_aplicacao() -> Application:
+    """Cria o Application do Telegram com todos os handlers."""
+    # concurrent_updates: sem isso o PTB processa um update por vez para todos os usuários
+    app = Application.builder().token(TOKEN_TELEGRAM).concurrent_updates(MAX_UPDATES_CONCORRENTES).build()
+
     app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("lote", lote_command))
+    app.add_handler(CommandHandler("recarregar", recarregar_command))
+    app.add_handler(CommandHandler("status", status_command))
     # Handler para todas as mensagens de texto que não são comandos
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, responder))
-    
-    print("🤖 Assistente de Estoque IA v2.4 rodando como Worker (Polling).")
-    
-    # 3. Inicia o Polling - run_until_stopped é o método que mantém o Worker ativo
-    await app.run_until_stopped()
+    return app
+
+def sinal_de_parada() -> asyncio.Event:
+    """Evento disparado por SIGINT/SIGTERM (o Render manda SIGTERM ao reiniciar o serviço)."""
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, parar.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # ex.: Windows
+    return parar
+
+def aquecer_clientes():
+    """Cria Gemini, Sheets e Calendar em segundo plano, para a primeira mensagem não pagar a construção."""
+    for nome, criar in (("gemini", obter_modelo), ("sheets", cliente_sheets), ("calendar", cliente_calendar)):
+        inicio = time.perf_counter()
+        try:
+            criar()
+        except Exception as e:
+            log.warning(f"⚠️ Não foi possível preparar o cliente {nome} (tenta de novo no primeiro uso): {e}")
+            continue
+        log.info(f"🔥 Cliente {nome} pronto em {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+
+def registrar_partida(modo: str):
+    """Mede o tempo do início do processo até o bot receber updates e dispara o aquecimento."""
+    segundos = time.perf_counter() - INICIO_PROCESSO
+    metricas.gauge("estoque_partida_segundos", lambda: segundos, "Do início do processo até o primeiro poll (ou webhook no ar).")
+    log.info(f"⏱️ Pronto para receber mensagens ({modo}) em {segundos * 1000:.0f} ms desde o início do processo.")
+    if AQUECER_CLIENTES:
+        threading.Thread(target=aquecer_clientes, name="aquecer-clientes", daemon=True).start()
+
+async def rodar_polling(app: Application):
+    parar = sinal_de_parada()
+    async with app:
+        await app.start()
+        await app.updater.start_polling()
+        registrar_partida("polling")
+        log.info("🤖 Assistente de Estoque IA v2.4 rodando como Worker (Polling).")
+        await parar.wait()
+        await app.updater.stop()
+        await app.stop()
+
+def montar_servidor_webhook(app: Application):
+    """
+    App aiohttp com a rota do webhook e as de observabilidade. Cada update é
+    confirmado na hora e processado em segundo plano, até WEBHOOK_MAX_CONCORRENTES juntos.
+    """
+    from aiohttp import web
+
+    limite = asyncio.Semaphore(WEBHOOK_MAX_CONCORRENTES)
+    tarefas: set = set()
+
+    async def processar(update: Update):
+        async with limite:
+            try:
+                await app.process_update(update)
+            except Exception as e:
+                log.exception(f"❌ Erro ao processar update do webhook: {e}")
+
+    async def receber_update(request: "web.Request") -> "web.Response":
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            dados = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="JSON inválido")
+        metricas.contar("estoque_webhook_updates_total")
+        tarefa = asyncio.create_task(processar(Update.de_json(dados, app.bot)))
+        tarefas.add(tarefa)
+        tarefa.add_done_callback(tarefas.discard)
+        return web.Response(text="ok")
+
+    async def observabilidade(request: "web.Request") -> "web.Response":
+        rota = rota_observabilidade(request.path)
+        if rota is None:
+            raise web.HTTPNotFound()
+        corpo, tipo = rota
+        return web.Response(body=corpo.encode("utf-8"), headers={"Content-Type": tipo})
+
+    servidor = web.Application()
+    servidor["tarefas"] = tarefas
+    servidor.router.add_post(WEBHOOK_PATH, receber_update)
+    for caminho in ("/metrics", "/healthz", "/debug/profile"):
+        servidor.router.add_get(caminho, observabilidade)
+    return servidor
+
+async def rodar_webhook(app: Application, porta: int):
+    from aiohttp import web
+
+    parar = sinal_de_parada()
+    servidor = montar_servidor_webhook(app)
+    runner = web.AppRunner(servidor, access_log=None)
+    async with app:
+        await app.start()
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", porta).start()
+        registrar_partida("webhook")
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            log.info(f"🤖 Assistente de Estoque IA v2.4 rodando via Webhook em {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}.")
+        else:
+            log.info(f"🤖 Webhook local (sem set_webhook) em http://0.0.0.0:{porta}{WEBHOOK_PATH}.")
+        await parar.wait()
+        await runner.cleanup()
+        # Termina os updates que já tinham sido aceitos antes de desligar
+        pendentes = list(servidor["tarefas"])
+        if pendentes:
+            await asyncio.wait(pendentes, timeout=30)
+        await app.stop()
+
+async def main_async():
+    """Função principal assíncrona para configurar e iniciar o bot."""
+    app = montar_aplicacao()
+    if MODO_EXECUCAO == "webhook":
+        await rodar_webhook(app, PORT or 10000)
+    else:
+        await rodar_polling(app)
+
+def registrar_gauges():
+    """Valores lidos na hora do scrape do /metrics."""
+    metricas.gauge("estoque_sessoes_ativas", lambda: len(pool_sessoes), "Chats Gemini mantidos em memória.")
+    metricas.gauge("estoque_memoria_acertos_lru", lambda: memoria_usuarios.acertos, "Leituras de memória servidas pelo LRU.")
+    metricas.gauge("estoque_atalho_acertos", lambda: ESTATISTICAS_ATALHO["acertos"], "Mensagens respondidas sem Gemini.")
+    metricas.gauge("estoque_planilha_metadados_evitados", lambda: registro_planilha.chamadas_evitadas, "Chamadas de metadados do Sheets evitadas.")
+    for nome, cota in COTAS.items():
+        metricas.gauge(f"estoque_cota_fila_{nome}", cota.na_fila, f"Chamadas esperando a cota {nome}.")
+    metricas.gauge("estoque_leituras_unidas", lambda: leituras_em_voo.unidas, "Leituras do Sheets atendidas por uma chamada igual em andamento.")
+    for nome, valor in backend_estoque.estatisticas().items():
+        if isinstance(valor, (int, float)):
+            metricas.gauge(f"estoque_backend_{nome}", lambda nome=nome: backend_estoque.estatisticas()[nome])
 
 def main():
     """Função de entrada que inicia a conexão Google e o loop assíncrono."""
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    verificar_configuracao()
+    servidor_metricas = None
     try:
+        if PROFILER_ATIVO:
+            profiler.iniciar()
+        registrar_gauges()
+        # No modo webhook /metrics e /healthz ficam no mesmo servidor do webhook
+        if MODO_EXECUCAO != "webhook":
+            servidor_metricas = iniciar_servidor_metricas(PORT)
         # A conexão Google deve ser chamada antes de iniciar o loop principal
         connect_to_google() 
+        backend_estoque.iniciar()
         
         # Inicia o loop assíncrono do Telegram
         asyncio.run(main_async())
         
     except Exception as e:
         # Este catch captura o erro fatal da conexão Google ou falha de inicialização
-        print("Erro ao iniciar:", e)
+        log.error(f"Erro ao iniciar: {e}")
+    finally:
+        if servidor_metricas is not None:
+            servidor_metricas.shutdown()
+        backend_estoque.encerrar()
+        memoria_usuarios.encerrar()
+        encerrar_executores()
+        profiler.encerrar()
 
 if __name__ == "__main__":
     main()